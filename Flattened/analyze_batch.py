@@ -0,0 +1,153 @@
+#!/usr/bin/python
+"""
+Driver script for analyzing many calculations (e.g. potential energy scans or
+trajectory snapshots) in one process.
+Every job directory has to contain an input file for analyze_tden.py or analyze_sden.py.
+"""
+
+import theo_header, lib_tden, lib_sden, lib_exciton, lib_pipeline, input_options, error_handler
+import os, sys, time, glob, contextlib, multiprocessing
+
+def ihelp():
+    print(" analyze_batch.py [options] <dir1> <dir2> ...")
+    print(" The directories may be given as glob patterns, e.g. 'step_*'")
+    print(" Command line options:")
+    print("  -h, -H, -help: print this help")
+    print("  -ifile, -f [dens_ana.in]: name of the input file in every directory")
+    print("  -sden: state density matrix analysis (default: transition density matrix analysis)")
+    print("  -nproc [1]: number of processes")
+    print("  -o [batch_summ.txt]: combined output table")
+    exit(0)
+
+def run_job(args):
+    """
+    Run the analysis in one directory.
+    The output is written to <ifile>.log in that directory.
+    Return a dictionary with the header and the rows of the summary.
+    """
+    ana_dir, ifile, sden = args
+    ret = {'dir': ana_dir, 'status': 'ok', 'header': [], 'rows': []}
+
+    pdir = os.getcwd()
+    try:
+        os.chdir(ana_dir)
+        with open(ifile + '.log', 'w') as logf, contextlib.redirect_stdout(logf):
+            if sden:
+                ioptions = input_options.sden_ana_options(ifile, check_init=False)
+                dena = lib_sden.sden_ana(ioptions)
+                pipe, targets = lib_pipeline.ret_sden_pipeline(dena)
+            else:
+                ioptions = input_options.tden_ana_options(ifile, check_init=False)
+                dena = lib_tden.tden_ana(ioptions)
+                pipe, targets = lib_pipeline.ret_tden_pipeline(dena, lib_exciton.exciton_analysis())
+
+            if ioptions.init > 0:
+                raise error_handler.MsgError("Input file %s not found"%ifile)
+
+            pipe.run_all(targets)
+            pipe.print_timings()
+
+        prop_list = ioptions.get('prop_list')
+        ret['header'] = prop_list
+        for state in dena.state_list:
+            row = [state['name'], state.get('exc_en'), state.get('osc_str')]
+            row += [dena.ret_prop_val(prop, state) for prop in prop_list]
+            ret['rows'].append(row)
+    except (Exception, SystemExit) as error:
+        ret['status'] = '%s: %s'%(error.__class__.__name__, error)
+    finally:
+        os.chdir(pdir)
+
+    return ret
+
+def write_table(results, ofile, oformat='% 10.5f'):
+    """
+    Write a combined table of all directories.
+    Properties that are not available in a directory are marked by '-'.
+    """
+    header = []
+    for res in results:
+        for prop in res['header']:
+            if not prop in header: header.append(prop)
+
+    width = len(oformat%0.)
+    dwidth = max([len(res['dir']) for res in results] + [3])
+    hstr = '%-*s %-10s'%(dwidth, 'dir', 'state') + '%*s'%(width, 'dE(eV)') + '%*s'%(width, 'f')
+    for prop in header:
+        hstr += '%*s'%(width, prop)
+
+    ostr = hstr + "\n" + len(hstr) * '-' + "\n"
+    for res in results:
+        for row in res['rows']:
+            vals = dict(zip(res['header'], row[3:]))
+            ostr += '%-*s %-10s'%(dwidth, res['dir'], row[0][-10:])
+            for val in row[1:3] + [vals.get(prop) for prop in header]:
+                try:
+                    ostr += oformat%val
+                except TypeError:
+                    ostr += '%*s'%(width, '-' if val is None else val)
+            ostr += "\n"
+
+    open(ofile, 'w').write(ostr)
+    print("Combined table written to %s"%ofile)
+
+#--------------------------------------------------------------------------#
+# Main
+#--------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+    theo_header.print_header('Batch analysis of density matrices')
+    (tc, tt) = (time.process_time(), time.time())
+
+    ifile = 'dens_ana.in'
+    sden = False
+    nproc = 1
+    ofile = 'batch_summ.txt'
+    ana_dirs = []
+
+    arg = sys.argv.pop(0)
+    while len(sys.argv) > 0:
+        arg = sys.argv.pop(0)
+        if arg in ["-h", "-H", "-help"]:
+            ihelp()
+        elif arg == '-ifile' or arg == '-f':
+            ifile = sys.argv.pop(0)
+        elif arg == '-sden':
+            sden = True
+        elif arg == '-nproc':
+            nproc = int(sys.argv.pop(0))
+        elif arg == '-o':
+            ofile = sys.argv.pop(0)
+        elif arg.startswith('-'):
+            raise error_handler.ElseError(arg, 'command line option')
+        else:
+            dirs = sorted(glob.glob(arg))
+            ana_dirs += [dirn for dirn in dirs if os.path.isdir(dirn)]
+
+    if len(ana_dirs) == 0:
+        print('No job directories found!\n')
+        ihelp()
+
+    print("Analyzing %i directories using %i process(es)\n"%(len(ana_dirs), nproc))
+
+    jobs = [(ana_dir, ifile, sden) for ana_dir in ana_dirs]
+    if nproc > 1:
+        # the worker processes are kept alive so that the parsed basis sets are reused
+        pool = multiprocessing.Pool(nproc)
+        results = pool.map(run_job, jobs, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        results = [run_job(job) for job in jobs]
+
+    nerr = 0
+    for res in results:
+        print("  %-30s %s"%(res['dir'], res['status']))
+        if res['status'] != 'ok': nerr += 1
+
+    print()
+    write_table([res for res in results if res['status'] == 'ok'], ofile)
+    if nerr > 0:
+        print(" WARNING: %i job(s) failed, see the log files in the directories"%nerr)
+
+    print("CPU time: % .1f s, wall time: %.1f s"%(time.process_time() - tc, time.time() - tt))
@@ -3,7 +3,7 @@
 Driver script for analyzing a set of NO files.
 """
 
-import theo_header, lib_sden, input_options
+import theo_header, lib_sden, lib_prof, lib_pipeline, input_options
 import os, sys
 
 theo_header.print_header('State density matrix analysis')
@@ -40,17 +40,13 @@ ioptions = input_options.sden_ana_options(ifile)
 # Parsing and computations
 #--------------------------------------------------------------------------#
 
-sdena = lib_sden.sden_ana(ioptions)
-if 'mo_file' in ioptions: sdena.read_mos()
-sdena.read_dens()
+if 'prof_file' in ioptions: lib_prof.prof.enable()
 
-if ioptions['AD_ana']:  sdena.compute_all_AD()
-if ioptions['BO_ana']:  sdena.compute_all_BO()
+sdena = lib_sden.sden_ana(ioptions)
 
-#--------------------------------------------------------------------------#        
-# Print out
-#--------------------------------------------------------------------------#
-if ioptions['pop_ana']: sdena.print_all_pop_table()
-if ioptions['BO_ana']:  sdena.print_all_BO()
+# the stages are evaluated according to the requested output, print-out is included
+pipe, targets = lib_pipeline.ret_sden_pipeline(sdena)
+pipe.run_all(targets)
+pipe.print_timings()
 
-sdena.print_summary()
+if 'prof_file' in ioptions: lib_prof.prof.write_json(ioptions['prof_file'])
@@ -3,11 +3,11 @@
 Driver script for transition density matrix analysis.
 """
 
-import theo_header, lib_tden, lib_exciton, input_options, error_handler
+import theo_header, lib_tden, lib_prof, lib_exciton, lib_pipeline, input_options, error_handler
 import os, sys, time
 
 theo_header.print_header('Transition density matrix analysis')
-(tc, tt) = (time.clock(), time.time())
+(tc, tt) = (time.process_time(), time.time())
 
 def ihelp():
     print(" analyze_tden.py")
@@ -39,29 +39,17 @@ if not os.path.exists(ifile):
     
 ioptions = input_options.tden_ana_options(ifile)
 
-tdena = lib_tden.tden_ana(ioptions)
-if 'mo_file' in ioptions: tdena.read_mos()
-    
-tdena.read_dens()
-
-if'at_lists' in ioptions:
-    tdena.compute_all_OmFrag()
-    if ioptions['print_OmFrag']:
-        tdena.fprint_OmFrag()
-        
-if ioptions['comp_ntos']: tdena.compute_all_NTO()
+if 'prof_file' in ioptions: lib_prof.prof.enable()
 
-if 'RMSeh' in ioptions.get('prop_list') or 'MAeh' in ioptions.get('prop_list') or 'Eb' in ioptions.get('prop_list'):
-    exca = lib_exciton.exciton_analysis()
-    exca.get_distance_matrix(tdena.struc)
-    tdena.analyze_excitons(exca)
+tdena = lib_tden.tden_ana(ioptions)
 
-#--------------------------------------------------------------------------#        
-# Print-out
-#--------------------------------------------------------------------------# 
+# the stages are evaluated according to the requested output
+pipe, targets = lib_pipeline.ret_tden_pipeline(tdena, lib_exciton.exciton_analysis())
+pipe.run_all(targets)
+pipe.print_timings()
 
-tdena.print_summary()
+if 'prof_file' in ioptions: lib_prof.prof.write_json(ioptions['prof_file'])
 
 #print 'Finished at ' + time.asctime()
 
-print("CPU time: % .1f s, wall time: %.1f s"%(time.clock() - tc, time.time() - tt))
+print("CPU time: % .1f s, wall time: %.1f s"%(time.process_time() - tc, time.time() - tt))
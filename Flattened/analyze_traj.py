@@ -0,0 +1,154 @@
+#!/usr/bin/python
+"""
+Driver script for transition density matrix analysis along a trajectory.
+Every time step is located in its own directory, all of them are analyzed
+with the same input file. The basis set has to be the same for all steps,
+the basis function and fragment mappings are only constructed once.
+"""
+
+import theo_header, lib_tden, lib_exciton, lib_pipeline, input_options, error_handler
+import os, sys, re, time, glob, contextlib
+
+def ihelp():
+    print(" analyze_traj.py [options] <dir1> <dir2> ...")
+    print(" The directories may be given as glob patterns, e.g. 'TRAJ/step_*'")
+    print("  they are sorted with respect to the numbers in their names.")
+    print(" Command line options:")
+    print("  -h, -H, -help: print this help")
+    print("  -ifile, -f [dens_ana.in]: name of the input file (relative to the current directory)")
+    print("  -o [traj_summ.txt]: output table, written after every step")
+    print("  -log [traj.log]: output of the individual steps")
+    exit(0)
+
+def natural_key(name):
+    """
+    Sort key such that step_10 comes after step_9.
+    """
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+class traj_ana:
+    """
+    Analysis of the time steps of a trajectory.
+    """
+    def __init__(self, ifile, ofile):
+        self.ifile = os.path.abspath(ifile)
+        self.ioptions = input_options.tden_ana_options(self.ifile)
+        self.prop_list = self.ioptions.get('prop_list')
+
+        self.ref_bas = None # basis function table of the first step
+        self.frag_parts = {} # fragment partitions, shared by all steps
+
+        self.oformat = '% 10.5f'
+        self.width = len(self.oformat%0.)
+        self.of = open(ofile, 'w')
+        self.write_header()
+
+    def write_header(self):
+        hstr = '%8s %-10s'%('step', 'state') + '%*s'%(self.width, 'dE(eV)') + '%*s'%(self.width, 'f')
+        for prop in self.prop_list:
+            hstr += '%*s'%(self.width, prop)
+        self.of.write(hstr + "\n" + len(hstr) * '-' + "\n")
+        self.of.flush()
+
+    def check_basis(self, tdena, step_dir):
+        """
+        Check that the basis set agrees with the first step.
+        Only the layout is compared, the exponents and contraction coefficients may differ.
+        """
+        if not hasattr(tdena, 'mos') or tdena.mos is None: return
+
+        if self.ref_bas is None:
+            self.ref_bas = tdena.mos.basis_fcts
+        elif self.ref_bas.same_layout(tdena.mos.basis_fcts):
+            # the table of the first step contains the atom partition already
+            tdena.mos.basis_fcts = self.ref_bas
+        else:
+            raise error_handler.MsgError("The basis set in %s differs from the first step!"%step_dir)
+
+    def run_step(self, istep, step_dir):
+        """
+        Analyze one time step and append the results to the output table.
+        """
+        ioptions = input_options.tden_ana_options(self.ifile)
+
+        tdena = lib_tden.tden_ana(ioptions)
+        tdena.frag_parts = self.frag_parts
+
+        pipe, targets = lib_pipeline.ret_tden_pipeline(tdena, lib_exciton.exciton_analysis())
+        pipe.run('mos')
+        self.check_basis(tdena, step_dir)
+        pipe.run_all(targets)
+
+        for state in tdena.state_list:
+            vstr = '%8i %-10s'%(istep, state['name'][-10:])
+            for val in [state.get('exc_en'), state.get('osc_str')] + [tdena.ret_prop_val(prop, state) for prop in self.prop_list]:
+                try:
+                    vstr += self.oformat%val
+                except TypeError:
+                    vstr += '%*s'%(self.width, '-')
+            self.of.write(vstr + "\n")
+
+        # the results are available even if the run is interrupted
+        self.of.flush()
+
+    def close(self):
+        self.of.close()
+
+#--------------------------------------------------------------------------#
+# Main
+#--------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+    theo_header.print_header('Transition density matrix analysis along a trajectory')
+    (tc, tt) = (time.process_time(), time.time())
+
+    ifile = 'dens_ana.in'
+    ofile = 'traj_summ.txt'
+    lfile = 'traj.log'
+    step_dirs = []
+
+    arg = sys.argv.pop(0)
+    while len(sys.argv) > 0:
+        arg = sys.argv.pop(0)
+        if arg in ["-h", "-H", "-help"]:
+            ihelp()
+        elif arg == '-ifile' or arg == '-f':
+            ifile = sys.argv.pop(0)
+        elif arg == '-o':
+            ofile = sys.argv.pop(0)
+        elif arg == '-log':
+            lfile = sys.argv.pop(0)
+        elif arg.startswith('-'):
+            raise error_handler.ElseError(arg, 'command line option')
+        else:
+            step_dirs += [dirn for dirn in glob.glob(arg) if os.path.isdir(dirn)]
+
+    if not os.path.exists(ifile):
+        print('Input file %s not found!\n'%ifile)
+        ihelp()
+
+    if len(step_dirs) == 0:
+        print('No step directories found!\n')
+        ihelp()
+
+    step_dirs.sort(key=natural_key)
+    print("Analyzing %i time steps, output written to %s"%(len(step_dirs), ofile))
+
+    ofile = os.path.abspath(ofile)
+    lfile = os.path.abspath(lfile)
+    pdir = os.getcwd()
+
+    trja = traj_ana(ifile, ofile)
+    with open(lfile, 'w') as logf:
+        for istep, step_dir in enumerate(step_dirs):
+            os.chdir(step_dir)
+            try:
+                with contextlib.redirect_stdout(logf):
+                    print("\n*** Step %i: %s ***"%(istep, step_dir))
+                    trja.run_step(istep, step_dir)
+            finally:
+                os.chdir(pdir)
+            print("  %8i %s"%(istep, step_dir))
+    trja.close()
+
+    print("CPU time: % .1f s, wall time: %.1f s"%(time.process_time() - tc, time.time() - tt))
@@ -4,7 +4,7 @@ http://cclib.github.io
 Download and install cclib if you want to use the functions.
 """
 
-import file_parser, lib_mo, error_handler, units, lib_struc
+import file_parser, lib_mo, lib_state, error_handler, units, lib_struc
 
 class file_parser_cclib(file_parser.file_parser_base):
     def __init__(self, *args, **kwargs):
@@ -29,7 +29,7 @@ class file_parser_cclib(file_parser.file_parser_base):
         """
         Convert the information to data analyzed by TheoDORE.
         """
-        state_list = []        
+        state_list = lib_state.state_table()
         
         try:
             core_orbs = sum(self.data.coreelectrons) / 2
@@ -132,7 +132,7 @@ class MO_set_cclib(lib_mo.MO_set_molden):
                
         for iat, baslist in enumerate(data.atombasis):
             for ibas in baslist:
-                self.basis_fcts.append(lib_mo.basis_fct(iat, '?', '?'))
+                self.basis_fcts.append(lib_mo.basis_fct(iat+1, '?', '?'))
                 
         try:
             self.syms = data.mosyms
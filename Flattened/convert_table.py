@@ -10,7 +10,7 @@ class write_table_options(input_options.write_options):
     def table_input(self):
         print("Convert the output from a TheoDORE run into a latex or html table.\n")
         
-        self.read_str("Name of the file to analyze", "ana_file", "tden_summ.txt")
+        self.read_str("Name of the file to analyze (text or .npz summary)", "ana_file", "tden_summ.txt")
         
         rstr = self.ret_str("Properties of interest (separated by spaces).\n  Leave empty to print all")
         if rstr == '':
@@ -34,10 +34,12 @@ class write_table_options(input_options.write_options):
         fformat = '%.' + str(digs) + 'f'
         self.write_option('fformat', fformat)
     
-    def write_table(self):
+    def write_table(self, nflush=1000):
+        """
+        Write the table. The rows are streamed to the file in blocks of nflush states.
+        """
         sfile = lib_file.summ_file(self['ana_file'])
         header = sfile.ret_header()
-        ddict  = sfile.ret_ddict()
         state_labels = sfile.ret_state_labels()
         
         if self['prop_list'] == []:
@@ -51,6 +53,19 @@ class write_table_options(input_options.write_options):
             wtable = lib_file.latextable
         else:
             raise error_handler.ElseError(self['output_format'], 'output_format')
+        
+        # formatted columns, missing and non-numerical entries are marked by '-'
+        cols = []
+        for prop in self['prop_list']:
+            try:
+                col = sfile.ret_col(prop)
+            except KeyError:
+                col = None
+            
+            if col is None or col.dtype.kind != 'f':
+                cols.append(['-'] * len(state_labels))
+            else:
+                cols.append(['-' if val != val else self['fformat']%val for val in col.tolist()])
             
         wf = wfile(self['fname'])        
         wf.pre(title='TheoDORE data')
@@ -58,17 +73,17 @@ class write_table_options(input_options.write_options):
         wt = wtable(ncol = len(self['prop_list']) + 1)
         wt.add_row(['State'] + self['prop_list'])
         
-        for state in state_labels:
+        for istate, state in enumerate(state_labels):
             if not self['lformula']:
                 wt.add_el(state)
             else:
                 wt.add_el('$%s$'%(state.replace('(', '^').replace(')', '')))
                 
-            for prop in self['prop_list']:
-                try:
-                    wt.add_el(self['fformat']%ddict[state][prop])
-                except KeyError:
-                    wt.add_el('-')
+            for col in cols:
+                wt.add_el(col[istate])
+                
+            if (istate + 1) % nflush == 0:
+                wt.flush(wf)
         
         wf.write(wt.ret_table())
         wf.post(lvprt=1)
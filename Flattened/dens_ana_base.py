@@ -1,5 +1,6 @@
-import file_parser, lib_mo, error_handler, cclib_interface, units, lib_struc
+import file_parser, lib_mo, error_handler, cclib_interface, units, lib_struc, lib_state, lib_cache, lib_prof
 import numpy
+import os, copy
 
 class dens_ana_base:
     """
@@ -9,27 +10,46 @@ class dens_ana_base:
         
         # state_list contains all the information about the states:
         #    quantities that are parsed from files as well as computed quantities
-        self.state_list = []
+        self.state_list = lib_state.state_table()
         
         self.ioptions = ioptions
+        lib_state.store.set_budget(ioptions.get('mem_budget', strict=False))
+        
+        # stages whose results could be taken from the cache file
+        self.cache_valid = []
+        self.cache_fps = None
+        self.cache_states = []
+        
+        # double precision data of one state for check_precision
+        self.mos64 = None
+        self.prec_sample = None
         
 #--------------------------------------------------------------------------#        
 # Input
 #--------------------------------------------------------------------------#          
 
-    def read_mos(self, lvprt=1):
+    @lib_prof.profile()
+    def read_mos(self, lvprt=1, comp_inv=True):
         """
         Read MOs from a separate file, which is given in Molden format.
+        If comp_inv=False, the inverse is only computed when it is needed.
         """
         self.mos = lib_mo.MO_set_molden(file=self.ioptions.get('mo_file'))
-        self.mos.read(lvprt=lvprt)
-        self.read2_mos(lvprt)
+        self.mos.read(lvprt=lvprt, sparse=self.ioptions['sparse_mos'])
+        self.read2_mos(lvprt, comp_inv)
 
-    def read2_mos(self, lvprt=1):
-        self.mos.compute_inverse()                    
+    def read2_mos(self, lvprt=1, comp_inv=True):
+        dtype = self.ioptions['dens_dtype']
+        if dtype != 'float64':
+            # the double precision MOs are kept until check_precision is done
+            self.mos64 = copy.copy(self.mos)
+            self.mos.set_dtype(dtype)
+            
+        if comp_inv: self.mos.compute_inverse(lvprt)
         self.num_mo  = self.mos.ret_num_mo()
         self.num_bas = self.mos.ret_num_bas()
         
+    @lib_prof.profile()
     def read_dens(self):
         """
         Read the (transition) density matrices and some supplementary information.
@@ -37,24 +57,18 @@ class dens_ana_base:
         rtype = self.ioptions.get('rtype')
         if self.ioptions['read_libwfa']: self.mos = None
         
-        if rtype=='ricc2':
-            self.state_list = file_parser.file_parser_ricc2(self.ioptions).read(self.mos)
-        elif rtype in ['tddft', 'escf', 'tmtddft']:
-            self.state_list = file_parser.file_parser_escf(self.ioptions).read(self.mos)
+        parser = self.ret_parser(rtype)
+        if not parser is None:
+            # the densities are converted to dens_dtype as soon as they are parsed
+            for state in parser.iter_read(self.mos):
+                self.convert_dens(state)
+            self.state_list = parser.state_list
         elif rtype=='libwfa':
             self.state_list = file_parser.file_parser_libwfa(self.ioptions).read()
         elif rtype=='qcadc':
             self.state_list = file_parser.file_parser_qcadc(self.ioptions).read()
         elif rtype=='qctddft':            
             self.state_list = file_parser.file_parser_qctddft(self.ioptions).read(self.mos)            
-        elif rtype in ['mcscf', 'colmcscf']:
-            self.state_list = file_parser.file_parser_col_mcscf(self.ioptions).read(self.mos)
-        elif rtype in ['mrci', 'colmrci']:
-            self.state_list = file_parser.file_parser_col_mrci(self.ioptions).read(self.mos)
-        elif rtype in ['rassi', 'molcas']:
-            self.state_list = file_parser.file_parser_rassi(self.ioptions).read(self.mos)
-        elif rtype.lower() == 'nos':
-            self.state_list = file_parser.file_parser_nos(self.ioptions).read(self.mos)
         elif rtype.lower() in ['cclib', 'gamess', 'orca']:
             # these are parsed with the external cclib library
             ccli = cclib_interface.file_parser_cclib(self.ioptions)
@@ -76,15 +90,103 @@ class dens_ana_base:
         else:
             raise error_handler.ElseError(rtype, 'rtype')
         
+        for state in self.state_list:
+            self.convert_dens(state)
         self.extra_info()
         
+    def iter_dens(self):
+        """
+        Generator over the states for the streaming mode.
+        The states are parsed one at a time, such that they can be analyzed and
+            their densities released before the next state is read.
+        Formats whose parsers do not support streaming are read at once.
+        """
+        rtype = self.ioptions.get('rtype')
+        
+        parser = self.ret_parser(rtype)
+        if parser is None:
+            print("\n Streaming not available for rtype=%s, reading all states at once"%rtype)
+            self.read_dens()
+            for state in self.state_list:
+                yield state
+            return
+        
+        self.read_struc()
+        for state in parser.iter_read(self.mos):
+            self.state_list = parser.state_list
+            self.convert_dens(state)
+            self.set_lam(state)
+            yield state
+        
+    def ret_parser(self, rtype):
+        """
+        Return the parser for the formats that are read state by state (iter_read),
+            None for the other formats.
+        """
+        if rtype=='ricc2':
+            parser = file_parser.file_parser_ricc2(self.ioptions)
+        elif rtype in ['tddft', 'escf', 'tmtddft']:
+            parser = file_parser.file_parser_escf(self.ioptions)
+        elif rtype in ['mcscf', 'colmcscf']:
+            parser = file_parser.file_parser_col_mcscf(self.ioptions)
+        elif rtype in ['mrci', 'colmrci']:
+            if self.ioptions['s_or_t'] == 's':
+                raise error_handler.MsgError('analyze_sden.py not implemented for col_mrci! Use "nos" instead.')
+            parser = file_parser.file_parser_col_mrci(self.ioptions)
+        elif rtype in ['rassi', 'molcas']:
+            parser = file_parser.file_parser_rassi(self.ioptions)
+        elif rtype.lower() == 'nos':
+            parser = file_parser.file_parser_nos(self.ioptions)
+        else:
+            parser = None
+            
+        return parser
+        
     def extra_info(self):
         for state in self.state_list:
-            try:
-                state['lam'] = units.energy['nm'] / (state['exc_en'] / units.energy['eV'])
-            except ZeroDivisionError:
-                pass
+            self.set_lam(state)
+        
+        self.read_struc()
+        
+    def set_lam(self, state):
+        try:
+            state['lam'] = units.energy['nm'] / (state['exc_en'] / units.energy['eV'])
+        except ZeroDivisionError:
+            pass
+        
+    def convert_dens(self, state):
+        """
+        Convert the densities of a state to the precision given by dens_dtype.
+        The densities are constructed in double precision by the parsers,
+            those of the first state are kept as the sample for check_precision
+            (as long as the double precision MOs are available).
+        """
+        dtype = self.ioptions['dens_dtype']
+        if dtype == 'float64': return
+        
+        dens = [key for key in lib_state.dens_keys if key in state]
+        if len(dens) == 0: return
         
+        if self.prec_sample is None and self.mos64 is not None:
+            # the parser may have reordered the MOs after read2_mos (symsort)
+            perm = self.mos64.ret_perm(inv=True)[self.mos.ret_perm()]
+            if not numpy.array_equal(perm, numpy.arange(len(perm))):
+                self.mos64.permute(perm)
+            # copied since the stored arrays may be memory-mapped files that are removed
+            self.prec_sample = (state, {key: numpy.array(state[key]) for key in dens})
+            
+        for key in dens:
+            state[key] = state[key].astype(dtype, copy=False)
+        
+    def release_dens(self, state, keep=[]):
+        """
+        Remove the densities of a state after the analysis (streaming mode).
+        """
+        for key in lib_state.dens_keys:
+            if key in state and not key in keep:
+                del state[key]
+        
+    def read_struc(self):
         if 'coor_file' in self.ioptions:
             self.struc = lib_struc.structure()
             self.struc.read_file(self.ioptions['coor_file'], self.ioptions['coor_format'])
@@ -94,7 +196,114 @@ class dens_ana_base:
         else:
             self.struc = None
             
+#--------------------------------------------------------------------------#          
+# Cache of the results
+#--------------------------------------------------------------------------#          
+
+    def ret_cache_file(self):
+        return os.path.splitext(self.ioptions['output_file'])[0] + '_cache.npz'
+        
+    def ret_cache_fps(self):
+        """
+        Return the fingerprints of the different stages.
+        -> This is overloaded in lib_tden.py
+        """
+        files = lib_cache.ret_input_files(self.ioptions)
+        return {'states': lib_cache.ret_fingerprint(self.ioptions, lib_cache.read_keys, files)}
+        
+    def ret_cache_keys(self):
+        """
+        Return a dictionary with the stage of every computed entry that is cached.
+        -> This is overloaded in lib_tden.py
+        """
+        return {}
+        
+    def read_cache(self):
+        """
+        Read the results of a previous run from the cache file.
+        The fingerprints have to be computed before the files are parsed
+            since some parsers modify the options.
+        """
+        self.cache_fps = self.ret_cache_fps()
+        
+        cache = lib_cache.state_cache(self.ret_cache_file())
+        cache_states, self.cache_valid = cache.read(self.cache_fps, self.ret_cache_keys())
+        
+        if cache_states is None:
+            print("\nNo valid results found in cache file %s"%cache.fname)
+            return
+            
+        print("\nResults for %i states read from cache file %s"%(len(cache_states), cache.fname))
+        print("  Valid stages: " + " ".join(self.cache_valid))
+        
+        self.cache_states = cache_states
+        self.state_list = cache_states
+        self.extra_info()
+        
+    def merge_cache(self, skip_stages=[]):
+        """
+        Copy the cached results into the newly parsed states (matched by name).
+        """
+        if len(self.cache_valid) == 0: return
+        
+        cache_keys = self.ret_cache_keys()
+        cache_dict = {}
+        for state in self.cache_states:
+            cache_dict[state['name']] = state
+            
+        for state in self.state_list:
+            if not state['name'] in cache_dict: continue
+            cstate = cache_dict[state['name']]
+            for key, stage in cache_keys.items():
+                if not stage in self.cache_valid or stage in skip_stages: continue
+                if key in cstate and not key in state:
+                    state[key] = cstate[key]
+                    
+    def write_cache(self):
+        """
+        Write the results to the cache file.
+        """
+        if self.cache_fps is None: self.cache_fps = self.ret_cache_fps()
+        
+        cache = lib_cache.state_cache(self.ret_cache_file())
+        cache.write(self.state_list, self.cache_fps, self.ret_cache_keys())
+        print("Results written to cache file %s"%cache.fname)
           
+#--------------------------------------------------------------------------#          
+# Precision
+#--------------------------------------------------------------------------#          
+
+    def check_precision(self):
+        """
+        Estimate the error of the reduced precision (dens_dtype) by repeating the
+            analysis of the sample state in double precision.
+        The double precision data are released afterwards.
+        """
+        if self.prec_sample is None: return
+        state, state64 = self.prec_sample
+        self.prec_sample = None
+        
+        mos = self.mos
+        self.mos = self.mos64
+        try:
+            devs = self.ret_precision_devs(state, state64)
+        finally:
+            self.mos = mos
+            self.mos64 = None
+        
+        print("\nPrecision check (dens_dtype=%s) for state %s"%(self.ioptions['dens_dtype'], state['name']))
+        print("  Maximal absolute deviations from double precision:")
+        for key, dev in devs:
+            print("  %-10s %.2e"%(key, dev))
+            
+    def ret_precision_devs(self, state, state64):
+        """
+        Return a list of (property, deviation) pairs comparing the state against
+            the dictionary state64 containing its densities in double precision.
+        -> This is overloaded in lib_tden.py and lib_sden.py
+        """
+        return []
+        
 #--------------------------------------------------------------------------#          
 # Output
 #--------------------------------------------------------------------------#          
@@ -136,13 +345,13 @@ class dens_ana_base:
             
             vstr += self.ret_val_string(prop_list, state, oformat)
             
-            prt_list.append([state['exc_en'], vstr])
+            prt_list.append([state['exc_en'], vstr, state])
             
-        prt_list.sort()
+        prt_list.sort(key=lambda el: el[:2])
         
         ostr  = hstr + "\n"
         ostr += len(hstr) * '-' + "\n"
-        for en, vstr in prt_list:
+        for en, vstr, state in prt_list:
             ostr += vstr + "\n"
         
         print("\n" + ostr)
@@ -151,6 +360,45 @@ class dens_ana_base:
             ofile = self.ioptions.get('output_file')
             print("Final output copied to %s"%ofile)
             open(ofile, 'w').write(ostr)
+            
+            if self.ioptions['output_bin']:
+                self.write_summary_bin(ofile + '.npz', prop_list, [el[2] for el in prt_list])
+            
+    def write_summary_bin(self, fname, prop_list, state_list):
+        """
+        Write the summary in columnar form with full precision into an .npz file.
+        The columns are stored as c1, c2, ... in the order given by header.
+        Missing values are stored as nan.
+        """
+        header = ['state', 'dE(eV)', 'f'] + list(prop_list)
+        
+        data = {}
+        data['header'] = numpy.array(header)
+        data['state'] = numpy.array([state['name'][-10:] for state in state_list])
+        data['name'] = numpy.array([state['name'] for state in state_list])
+        
+        for icol, prop in enumerate(header[1:]):
+            if prop == 'dE(eV)':
+                vals = [state['exc_en'] for state in state_list]
+            elif prop == 'f':
+                vals = [state.get('osc_str') for state in state_list]
+                vals = [None if val == -1. else val for val in vals]
+            else:
+                vals = [self.ret_prop_val(prop, state) for state in state_list]
+                
+            if len(vals) > 0 and all(isinstance(val, str) for val in vals):
+                data['c%i'%(icol+1)] = numpy.array(vals)
+                continue
+            
+            col = numpy.zeros(len(vals))
+            for ival, val in enumerate(vals):
+                try:
+                    col[ival] = float(val)
+                except (TypeError, ValueError):
+                    col[ival] = numpy.nan
+            data['c%i'%(icol+1)] = col
+            
+        numpy.savez_compressed(fname, **data)
         
     def ret_header_string(self, prop_list, width=7):
         ret_str = ''
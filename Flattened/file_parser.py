@@ -2,18 +2,38 @@
 Parsing of files produced by different quantum chemical programs.
 """
 
-import units, lib_mo, error_handler
+import units, lib_mo, lib_state, lib_prof, error_handler
 import numpy
-import os, struct
+import os, io, struct, contextlib, multiprocessing
 
 class file_parser_base:
     def __init__(self, ioptions):
         self.ioptions = ioptions
         
     def read(self):
-        state_list = []
+        state_list = lib_state.state_table()
         
         return state_list
+    
+    def iter_read(self, *args):
+        """
+        Generator over the states, which allows to analyze every state and release
+            its density before the next state is read.
+        The table with all states is available as self.state_list.
+        -> This is overloaded by the parsers that support streaming,
+           the default is to read all states at once.
+        """
+        self.state_list = self.read(*args)
+        for state in self.state_list:
+            yield state
+            
+    def read_all(self, *args):
+        """
+        Read all states using iter_read.
+        """
+        for state in self.iter_read(*args): pass
+        
+        return self.state_list
    
     def init_den(self, mos, rect=False):
         """
@@ -38,6 +58,24 @@ class file_parser_base:
             sr_line = line.strip(search_string).replace(',','')
             state[key] = float(sr_line.split()[ind])
             
+    @staticmethod
+    def read_fixed_block(rfile, nval, width=18, ncol=5):
+        """
+        Read nval numbers given in fixed-width fields (ncol per line) from rfile.
+        The Fortran exponents (D) of the whole block are translated at once
+            and the fields are converted in one numpy call.
+        """
+        lines = [next(rfile)[:ncol * width] for iline in range(nval // ncol)]
+        if nval % ncol > 0:
+            lines.append(next(rfile)[:(nval % ncol) * width])
+        
+        buf = ''.join(lines)
+        if len(buf) != nval * width:
+            raise error_handler.MsgError('fixed-width block: %i characters read for %i values'%(len(buf), nval))
+        
+        buf = buf.replace('D', 'E').replace('d', 'e')
+        return numpy.frombuffer(buf.encode(), dtype='S%i'%width).astype(numpy.float64)
+        
     def delete_chars(self, line, delete):
         """
         Delete the characters in <delete> from line.
@@ -97,11 +135,18 @@ class file_parser_ricc2(file_parser_base):
     Turbomole ricc2
     """
     def read(self, mos):
-        state_list = self.ret_conf_ricc2(rfile=self.ioptions.get('rfile'))
+        return self.read_all(mos)
+    
+    def iter_read(self, mos):
+        self.state_list = self.ret_conf_ricc2(rfile=self.ioptions.get('rfile'))
         
-        ihomo  = mos.ret_ihomo()
+        # the binary files are sorted by symmetry
+        #   (this only changes the MOs, the parsing does not depend on the order)
+        if self.ioptions.get('read_binary'):
+               mos.symsort(self.ioptions['irrep_labels'])
+               self.ioptions['jmol_orbitals'] = False
         
-        for state in state_list:
+        for state in self.state_list:
             state['name'] = '%i(%s)%s'%(state['state_ind'], state['mult'], state['irrep'])
             state['tden'] = self.init_den(mos, rect=True)
 
@@ -110,25 +155,21 @@ class file_parser_ricc2(file_parser_base):
             else:
                 self.set_tden_conf(state, mos)
                 
-        if self.ioptions.get('read_binary'):
-               mos.symsort(self.ioptions['irrep_labels'])
-               self.ioptions['jmol_orbitals'] = False
- 
-        return state_list
+            yield state
    
+    @lib_prof.profile()
     def set_tden_conf(self, state, mos):
         """
         Set the transition density matrix elements acoording to the parsed configurations.
         """
         for conf in state['char']:
             # look for the orbital in the MO file. This makes sure that the procedure works even when the MOs are reordered because of symmetry.
-            iocc  = mos.syms.index(conf.occ)
-           
-            #print conf.virt, mos.syms.index(conf.virt), mos.syms.index(conf.virt) - ihomo, conf.coeff
-            ivirt = mos.syms.index(conf.virt)
+            iocc  = mos.ret_imo(conf.occ)
+            ivirt = mos.ret_imo(conf.virt)
 
             state['tden'][iocc,ivirt] = conf.coeff
                 
+    @lib_prof.profile()
     def set_tden_bin(self, state, mos, lvprt=1):
         """
         Set the transition density matrix elements acoording to the binary files with state information.
@@ -141,19 +182,16 @@ class file_parser_ricc2(file_parser_base):
 
         if lvprt >= 1: print('Reading binary file %s ...'%CCfilen)
 
-        CCfile = open(CCfilen, 'rb')
-        CCfile.read(8)
-        method = struct.unpack('8s', CCfile.read(8))[0]
-        CCfile.read(8)
-        nentry = struct.unpack('i', CCfile.read(4))[0]
-        CCfile.read(20)
+        method, amps = self.read_CCRE0(CCfilen)
+        nentry = len(amps)
 
         num_mo = mos.ret_num_mo()
         nocc  = mos.ret_ihomo() + 1
         nvirt = num_mo - nocc
         
-        assert(nentry % nvirt == 0)        
-        nact = nentry / nvirt
+        if nentry % nvirt != 0:
+            raise error_handler.MsgError('parsing file %s: %i entries for %i virtual orbitals'%(CCfilen, nentry, nvirt))
+        nact = nentry // nvirt
         nfrzc = nocc - nact
         
         if lvprt >= 1:
@@ -166,25 +204,58 @@ class file_parser_ricc2(file_parser_base):
             print('\n\n  WARNING: Frozen core orbitals should be kept out of the molden file when Reading CCRE0* files!\n')
             
         # write the collected data into the correct block of the 1TDM
-        for iocc in range(nfrzc, nocc):
-            for ivirt in range(nocc, num_mo):
-                state['tden'][iocc, ivirt] = struct.unpack('d', CCfile.read(8))[0]
-
-        lbytes = struct.unpack('4s', CCfile.read(4))
-        if lvprt >= 2:
-            print('   Last four bytes:', lbytes)
-        if not CCfile.read(1) == '':
-            raise error_hanlder.MSGError('parsing file %s'%CCfilen)
+        #   the amplitudes are stored with the virtual index running fastest
+        state['tden'][nfrzc:nocc, nocc:num_mo] = amps.reshape(nact, nvirt)
 
         if lvprt >= 3:
             print('parsed tden:')
             print(state['tden'])
 
+    def read_CCRE0(self, CCfilen):
+        """
+        Read the amplitudes from a CCRE0 file.
+        The file contains two unformatted Fortran records, each of them enclosed by
+            4-byte markers with the record length:
+          header: int32, method (8 characters), float64, number of entries (int64), float64
+          amplitudes: float64 array
+        The byte order is determined from the first marker.
+        Return the method and the amplitudes.
+        """
+        hlen = 36
+        
+        with open(CCfilen, 'rb') as CCfile:
+            marker = CCfile.read(4)
+            for endian in ['<', '>']:
+                if len(marker) == 4 and struct.unpack(endian + 'i', marker)[0] == hlen: break
+            else:
+                raise error_handler.MsgError('parsing file %s: invalid header record'%CCfilen)
+            
+            hdr = CCfile.read(hlen + 8)
+            if len(hdr) < hlen + 8:
+                raise error_handler.MsgError('parsing file %s: file truncated'%CCfilen)
+            (ival, method, dval, nentry, dval2, lend, lamp) = struct.unpack(endian + 'i8sdqdii', hdr)
+            if lend != hlen:
+                raise error_handler.MsgError('parsing file %s: invalid header record'%CCfilen)
+            if lamp != 8 * nentry:
+                raise error_handler.MsgError('parsing file %s: record length %i for %i entries'%(CCfilen, lamp, nentry))
+            
+            amps = numpy.fromfile(CCfile, dtype=endian + 'f8', count=nentry)
+            if len(amps) < nentry:
+                raise error_handler.MsgError('parsing file %s: file truncated'%CCfilen)
+            
+            marker = CCfile.read(4)
+            if len(marker) < 4 or struct.unpack(endian + 'i', marker)[0] != lamp:
+                raise error_handler.MsgError('parsing file %s: invalid trailing record marker'%CCfilen)
+            if not CCfile.read(1) == b'':
+                raise error_handler.MsgError('parsing file %s: unexpected data after the amplitudes'%CCfilen)
+            
+        return method.decode(errors='replace').strip(), amps.astype(numpy.float64, copy=False)
+
     def ret_conf_ricc2(self, rfile='ricc2.out'):
         """
         Return information about configurations in a Turbomole calculation.
         """
-        ret_list = []
+        ret_list = lib_state.state_table()
         curr_osc = 0 # running index for oscillator strengths
         lines = open(rfile,'r') 
         while True: # loop over all lines
@@ -248,27 +319,19 @@ class file_parser_escf(file_parser_base):
     Turbomole TDDFT
     """
     def read(self, mos):
-        state_list = self.ret_conf_tddft(rfile=self.ioptions.get('rfile'))
+        return self.read_all(mos)
+    
+    def iter_read(self, mos):
+        self.state_list = self.ret_conf_tddft(rfile=self.ioptions.get('rfile'))
         
-        nocc={}
-        nvirt={}
-
-        for state in state_list:
+        irrep_maps = {}
+        for state in self.state_list:
             state['name'] = '%i%s'%(state['state_ind'],state['irrep'])
             state['tden'] = self.init_den(mos, rect=True)
             
-            occmap  = []
-            virtmap = []
-            for iorb, sym in enumerate(mos.syms):
-                if state['irrep'] in sym:
-                    occ = mos.occs[iorb]
-                    if abs(occ-2.) < 1.e-4:
-                        occmap.append(iorb)
-                    elif abs(occ) < 1.e-4:
-                        virtmap.append(iorb)
-                    else:
-                        print(" Error: invalid occupation!", occ)
-                        exit(5)
+            if not state['irrep'] in irrep_maps:
+                irrep_maps[state['irrep']] = self.ret_irrep_maps(mos, state['irrep'])
+            occmap, virtmap = irrep_maps[state['irrep']]
 
             nocc=len(occmap)
             nvirt=len(virtmap)
@@ -321,11 +384,30 @@ class file_parser_escf(file_parser_base):
                                 break
                 elif curr_state > state['state_ind']: break
                 
-        return state_list
+            yield state
+            
+    def ret_irrep_maps(self, mos, irrep):
+        """
+        Return the indices of the occupied and virtual MOs of an irrep.
+        """
+        occmap  = []
+        virtmap = []
+        for iorb, sym in enumerate(mos.syms):
+            if irrep in sym:
+                occ = mos.occs[iorb]
+                if abs(occ-2.) < 1.e-4:
+                    occmap.append(iorb)
+                elif abs(occ) < 1.e-4:
+                    virtmap.append(iorb)
+                else:
+                    print(" Error: invalid occupation!", occ)
+                    exit(5)
+                    
+        return occmap, virtmap
     
     def ret_conf_tddft(self, rfile):
         rlines = open(rfile, 'r').readlines()[100:]
-        ret_list = []
+        ret_list = lib_state.state_table()
         occ_orb = False # section of the file
         for nr,line in enumerate(rlines):
             if 'excitation' in line and not 'vector' in line:
@@ -364,7 +446,7 @@ class file_parser_libwfa(file_parser_base):
         Read the .om files as created with libwfa.
         These already contain OmAt
         """
-        state_list = []
+        state_list = lib_state.state_table()
         
         basedir='.'
         #ist = 1
@@ -480,7 +562,7 @@ class file_parser_qcadc(file_parser_libwfa):
     Parse information from qchem.out in addition to the .om file.
     """
     def read(self):
-        state_list = []
+        state_list = lib_state.state_table()
         
         basedir='.'
         
@@ -581,7 +663,7 @@ class file_parser_qctddft(file_parser_libwfa):
         """
         Read the X vector from standard output. Y is discarded.
         """
-        state_list = []
+        state_list = lib_state.state_table()
         exc_diff = False
         exc_1TDM = False
         tdread = False
@@ -745,18 +827,12 @@ class file_parser_col(file_parser_base):
         """
         raise error_handler.NIError()
     
+    @lib_prof.profile()
     def read_trncils(self, state, mos, filen):
         """
         Read output from transci.x for a 1-particle density file.
+        The MO labels have to be set with set_syms2.
         """
-        # change the format of the MO labels
-        mos.syms2 = [sym.lower().replace('_','') for sym in mos.syms]
-        if not self.ioptions['ncore'] == {}:
-            for isym, sym2 in enumerate(mos.syms2):
-                imo, irr = self.sym_split(sym2)                
-                new = "%i%s"%(imo-self.ioptions['ncore'][irr], irr)
-                mos.syms2[isym] = new
-        
         state['tden'] = self.init_den(mos)
         
         tmp = filen.replace('state','').replace('drt','').replace('trncils.FROM','').split('TO')
@@ -792,6 +868,21 @@ class file_parser_col(file_parser_base):
                 state['osc_str']=float(words[-1])
         rfile.close()
                 
+    def set_syms2(self, mos):
+        """
+        Set the MO labels in the format of the Columbus listings (mos.syms2),
+            where the core orbitals given in ncore are not counted.
+        This is done once for all files.
+        """
+        syms2 = [sym.lower().replace('_','') for sym in mos.syms]
+        if not self.ioptions['ncore'] == {}:
+            for isym, sym2 in enumerate(syms2):
+                imo, irr = self.sym_split(sym2)                
+                syms2[isym] = "%i%s"%(imo-self.ioptions['ncore'][irr], irr)
+                
+        mos.syms2 = syms2
+        mos.set_label_index('syms2')
+                
     def read_block_mat(self, state, mos, rfile, sym):
         """
         Parse the block matrix output in the listing file.
@@ -800,25 +891,25 @@ class file_parser_col(file_parser_base):
         isqr2 = 1. / numpy.sqrt(2.)       
 
         while(1):
-            words=rfile.next().replace('MO','').split()
+            words=next(rfile).replace('MO','').split()
             
             if 'density' in words: # skip two lines in case the next symmetry block is coming
                 line=next(rfile)
-                words=rfile.next().replace('MO','').split()
+                words=next(rfile).replace('MO','').split()
             
             try:
-                head_inds = [mos.syms2.index(sym2) for sym2 in words]
+                head_inds = [mos.ret_imo(sym2, 'syms2') for sym2 in words]
             except:
                 print(" ERROR reading:", words)
                 print("syms2: ", mos.syms2)
                 print()
                 raise
             
-            words=rfile.next().replace('MO','').split()
+            words=next(rfile).replace('MO','').split()
             while(len(words)>0): # loop over a block with constant header labels
                 if 'integral' in words: break
                 try:
-                    left_ind = mos.syms2.index(words[0])
+                    left_ind = mos.ret_imo(words[0], 'syms2')
                 except:
                     print('\n ERROR parsing: ')
                     print(words)
@@ -833,7 +924,7 @@ class file_parser_col(file_parser_base):
                     if left_ind != head_inds[i]:
                         state['tden'][left_ind,head_inds[i]] += isqr2 * sym*val
                         
-                words=rfile.next().replace('MO','').split()
+                words=next(rfile).replace('MO','').split()
                 
             if 'integral' in words: break
     
@@ -841,21 +932,28 @@ class file_parser_col_mrci(file_parser_col):
     def read(self, mos):
         if self.ioptions['s_or_t'] == 's':
             raise error_handler.MsgError('analyze_sden.py not implemented for col_mrci! Use "nos" instead.')
-            
-        state_list = []
+        
+        return self.read_all(mos)
+    
+    def iter_read(self, mos):
+        self.state_list = lib_state.state_table()
+        self.set_syms2(mos)
         
         for lfile in sorted(os.listdir('LISTINGS')):
             if not 'trncils' in lfile: continue
             
             print("Reading %s ..."%lfile)
-            state_list.append({})
-            self.read_trncils(state_list[-1], mos, 'LISTINGS/%s'%lfile)
-
-        return state_list
+            state = self.state_list.append({})
+            self.read_trncils(state, mos, 'LISTINGS/%s'%lfile)
+            
+            yield state
     
 class file_parser_col_mcscf(file_parser_col):
     def read(self, mos):
-        state_list = []
+        return self.read_all(mos)
+    
+    def iter_read(self, mos):
+        self.state_list = lib_state.state_table()
         
         for lfile in sorted(os.listdir('WORK')):
             # Find the suitable files. This could also be done with regexps ...
@@ -867,21 +965,22 @@ class file_parser_col_mcscf(file_parser_col):
                 if not '-' in lfile: continue
                 
                 print("Reading %s ..."%lfile)
-                state_list.append({})
-                self.read_mc_tden(state_list[-1], mos, lfile)
+                state = self.state_list.append({})
+                self.read_mc_tden(state, mos, lfile)
+                yield state
                 
             elif self.ioptions['s_or_t'] == 's':
                 if '-' in lfile: continue
                 
                 print("Reading %s ..."%lfile)
-                state_list.append({})
-                self.read_mc_sden(state_list[-1], mos, lfile)
+                state = self.state_list.append({})
+                self.read_mc_sden(state, mos, lfile)
+                yield state
         
-        if len(state_list) == 0:
+        if len(self.state_list) == 0:
             raise error_handler.MsgError('No density file found! Did you run write_den.bash?')
-        
-        return state_list
     
+    @lib_prof.profile()
     def read_mc_tden(self, state, mos, filen):
         tmp = filen.replace('mcsd1fl.drt','').replace('st','').replace('.iwfmt','').split('.')
         state['irrep'] = self.ioptions.get('irrep_labels')[int(tmp[0]) - 1]
@@ -895,6 +994,7 @@ class file_parser_col_mcscf(file_parser_col):
         # read antisymmetric part
         self.read_iwfmt(state['tden'], 'WORK/'+filen.replace('mcsd1fl', 'mcad1fl'), fac=1/numpy.sqrt(2.))
         
+    @lib_prof.profile()
     def read_mc_sden(self, state, mos, filen):
         tmp = filen.replace('mcsd1fl.drt','').replace('st','').replace('.iwfmt','').split('.')
         state['irrep'] = self.ioptions.get('irrep_labels')[int(tmp[0]) - 1]
@@ -910,16 +1010,18 @@ class file_parser_nos(file_parser_base):
     Interpret the MO-file as a diagonal density.
     """
     def read(self, mos):
-        state_list = []
+        return self.read_all(mos)
+    
+    def iter_read(self, mos):
+        self.state_list = lib_state.state_table()
         
         #state_list.append({})
         #self.read_ref_nos(state_list[-1], mos)
         
-        for no_file in self.ioptions['ana_files']:
-            state_list.append({})
-            self.read_no_file(state_list[-1], mos, no_file)
+        for istate, no_file in enumerate(self.ioptions['ana_files']):
+            state = self.state_list.append({})
+            self.read_no_file(state, mos, no_file)
             
-        for istate, state in enumerate(state_list):
             state['exc_en'] = float(istate + 1) # set fake excitation energy
             state['state_num'] = istate + 1
             
@@ -933,8 +1035,8 @@ class file_parser_nos(file_parser_base):
             tmp_name = tmp_name.replace('NOs/','').replace('.mo', '')
             
             state['name'] = tmp_name
-
-        return state_list    
+            
+            yield state
     
     def read_ref_nos(self, state, ref_nos):
         """
@@ -952,6 +1054,7 @@ class file_parser_nos(file_parser_base):
             state['nunl'] = sum(nunl_list)
             state['nunl_den'] = numpy.diag(nunl_list)
             
+    @lib_prof.profile()
     def read_no_file(self, state, ref_mos, no_file):
         """
         Read information from a secondary NO file.
@@ -986,9 +1089,27 @@ class file_parser_nos(file_parser_base):
             state['nunl_den'] = numpy.dot(T,
                                   numpy.dot(numpy.diag(nunl_list), T.transpose()))
             
+def read_rassi_job(args):
+    """
+    Read one RASSI density file, this is the worker function for file_parser_rassi.iter_pair_dens.
+    Return the density and the print-out, which is written by the main process.
+    """
+    filen, num_mo, sden, lvprt = args
+    
+    dens = numpy.zeros([num_mo, num_mo])
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        file_parser_rassi.read_rassi_den(dens, filen, sden, lvprt)
+        
+    return dens, out.getvalue()
+
 class file_parser_rassi(file_parser_base):
     def read(self, mos):
-        state_list = []
+        return self.read_all(mos)
+    
+    def iter_read(self, mos):
+        self.state_list = lib_state.state_table()
+        state_list = self.state_list
         
         (energies, oscs) = self.read_rassi_output(self.ioptions['rfile'])
         
@@ -1000,38 +1121,64 @@ class file_parser_rassi(file_parser_base):
     
             raise error_handler.MsgError(errmsg)
         
-        for lfile in self.ioptions['ana_files']:
-            words = lfile.split('_')
-            (st1, st2) = (int(words[1]), int(words[2]))
+        sden = self.ioptions['s_or_t'] == 's'
+        pairs = self.ret_pairs(sden)
+        
+        for (lfile, st1, st2), (dens, out) in zip(pairs, self.iter_pair_dens(pairs, mos.ret_num_mo(), sden)):
+            print("Reading %s ..."%lfile)
+            print(out, end='')
+            state_list.append({})
             
-            if self.ioptions['s_or_t'] == 't':
-                if st1 == st2: continue
-                
-                print("Reading %s ..."%lfile)
-                state_list.append({})
-                
+            if not sden:
                 state_list[-1]['name'] = 'R%i.%i'%(st1, st2)
                 state_list[-1]['exc_en'] = (energies[st1-1] - energies[st2-1]) * units.energy['eV']
                 try:
                     state_list[-1]['osc_str'] = oscs[(st2, st1)]
                 except:
                     print("No osc. strength found for transition %i -> %i"%(st2, st1))
-                state_list[-1]['tden'] = self.init_den(mos)
-
-                self.read_rassi_den(state_list[-1]['tden'], mos, lfile)
-        
-            elif self.ioptions['s_or_t'] == 's':
-                if st1 != st2: continue
-                
-                print("Reading %s ..."%lfile)
-                state_list.append({})
-                
+                state_list[-1]['tden'] = dens
+            else:
                 state_list[-1]['name'] = 'RASSI_%i'%st1
                 state_list[-1]['exc_en'] = (energies[st1-1] - energies[0]) * units.energy['eV']
-                state_list[-1]['sden'] = self.init_den(mos)
-
-                self.read_rassi_den(state_list[-1]['sden'], mos, lfile, sden=True)
-        return state_list
+                state_list[-1]['sden'] = dens
+                
+            yield state_list[-1]
+            
+    def ret_pairs(self, sden):
+        """
+        Return the files in ana_files with the state indices.
+        Only the diagonal files are taken for state densities and
+            only the off-diagonal files for transition densities.
+        """
+        pairs = []
+        for lfile in self.ioptions['ana_files']:
+            words = lfile.split('_')
+            (st1, st2) = (int(words[1]), int(words[2]))
+            if (st1 == st2) == sden:
+                pairs.append((lfile, st1, st2))
+                
+        return pairs
+        
+    def iter_pair_dens(self, pairs, num_mo, sden):
+        """
+        Generator over the densities and print-outs of the files in pairs (in this order).
+        With nproc > 1 the files are read in a process pool, the results are passed on
+            in order as soon as they are available.
+        """
+        jobs = [(lfile, num_mo, sden, self.ioptions['lvprt']) for lfile, st1, st2 in pairs]
+        nproc = min(self.ioptions['nproc'], len(jobs))
+        
+        if nproc > 1:
+            pool = multiprocessing.Pool(nproc)
+            try:
+                # one file per task, since every file is large
+                for res in pool.imap(read_rassi_job, jobs, chunksize=1):
+                    yield res
+            finally:
+                pool.terminate()
+        else:
+            for job in jobs:
+                yield read_rassi_job(job)
     
     def read_rassi_output(self, filen):
         """
@@ -1042,51 +1189,48 @@ class file_parser_rassi(file_parser_base):
         
         rfile = open(filen,'r')
         
-        while(True):
-            line = next(rfile)
-            
+        for line in rfile:
             if 'Total energies (spin-free)' in line:
-                words = rfile.next().split()
+                words = next(rfile).split()
                 while(len(words) > 0):
                     energies.append(float(words[-1]))
-                    words = rfile.next().split()
+                    words = next(rfile).split()
             
             if 'To  From     Osc. strength   Einstein coefficients' in line:
                 next(rfile)
                 next(rfile)
                 next(rfile)
-                words = rfile.next().split()
+                words = next(rfile).split()
                 while(len(words) > 1):
                     ist = int(words[0])
                     jst = int(words[1])
                     osc = float(words[2])
                     oscs[(ist, jst)] = osc
-                    words = rfile.next().split()
+                    words = next(rfile).split()
                 break
 
-        
         rfile.close()
         
         return energies, oscs
         
-    def read_rassi_den(self, dens, mos, filen, sden=False):
+    @staticmethod
+    @lib_prof.profile()
+    def read_rassi_den(dens, filen, sden=False, lvprt=1):
         """
         Read the output of RASSI generated with TRD1.
+        The active-active block is converted at once with read_fixed_block.
+        Static since it is called by the worker processes (read_rassi_job).
         No support for symmetry (yet).
         """
-        trd1 = False
-        imo = -1
-        jmo = -1
-        rfile = open(filen,'r')
+        ninact = 0
+        nact = None
+        vals = None
         TRD_string = 'Active TRD1'
-        while True:
-            try:
-                line = next(rfile)
-            except StopIteration:
-                break
-            
+        
+        rfile = open(filen,'r')
+        for line in rfile:
             if 'Multiplicities' in line:
-                words = rfile.next().split()
+                words = next(rfile).split()
                 mult1 = int(words[0])
                 mult2 = int(words[1])
                 print('Multiplicities: %i, %i'%(mult1, mult2))
@@ -1098,39 +1242,33 @@ class file_parser_rassi(file_parser_base):
                 else:
                     TRD_string = 'Active Spin TRD1'
             elif 'Basis functions' in line:
-                nbas = int(rfile.next().split()[0])
-                assert(nbas == mos.ret_num_mo())
+                nbas = int(next(rfile).split()[0])
+                assert(nbas == len(dens))
             elif 'Inactive orbitals' in line:
-                ninact = int(rfile.next().split()[0])
-                
-                if sden:
-                    for imo in range(ninact): dens[imo, imo] = 2.0                        
-                imo = ninact
-                jmo = ninact
+                ninact = int(next(rfile).split()[0])
             elif 'Active orbitals' in line:
-                nact = int(rfile.next().split()[0])
-            elif TRD_string in line:
-                line = next(rfile)
-                trd1 = True
-            elif trd1:
-                #print imo, line[:-1]
-                for i in range(5):
-                    val = float(line[i*18:(i+1)*18].replace('D','E'))
-                    dens[jmo, imo] = val
-                    if 0.2 < abs(val) < 1.9999: print("(i,j)=(%2i,%2i), val=%6.3f"%(imo,jmo,val))
-                    
-                    jmo += 1
-                    if jmo == ninact + nact:
-                        jmo = ninact
-                        imo += 1
-                        
-                        if imo == ninact + nact:
-                            #print "Finished parsing"
-                            trd1 = False
-                            break        
+                nact = int(next(rfile).split()[0])
+            elif TRD_string in line and nact is not None:
+                next(rfile)
+                vals = file_parser_base.read_fixed_block(rfile, nact * nact)
+                break
         rfile.close()
-        if trd1:
+        
+        if vals is None:
             raise error_handler.MsgError('Parsing of RASSI output')
+        
+        if sden:
+            for imo in range(ninact): dens[imo, imo] = 2.0
+        
+        # the first index (column of dens) runs slowest
+        block = vals.reshape(nact, nact)
+        act = slice(ninact, ninact + nact)
+        dens[act, act] = block.transpose()
+        
+        if lvprt >= 2:
+            for imo, jmo in numpy.argwhere((abs(block) > 0.2) & (abs(block) < 1.9999)):
+                print("(i,j)=(%2i,%2i), val=%6.3f"%(imo + ninact, jmo + ninact, block[imo, jmo]))
+        
         if not sden:
             dens *= 2**(-.5)
             
@@ -372,6 +372,13 @@ class dens_ana_options(read_options):
         self['read_libwfa'] = False # switch to libwfa output (applicable for qctddft)
         self['s_or_t'] = None # state or transition density matrix analysis
         self['ignore_irreps'] = [] # ignore irreps in the MO file
+        self['sparse_mos'] = False # store the MO coefficients as a sparse matrix (requires scipy)
+        self['use_cache'] = False # reuse the results of a previous run stored in <output_file>_cache.npz
+        self['mem_budget'] = None # memory (MB) for the densities, beyond this they are moved to memory-mapped files
+        self['stream'] = False # read and analyze the states one at a time, the densities are released afterwards
+        self['dens_dtype'] = 'float64' # precision of the MO coefficients and densities ('float32' halves the memory)
+        self['nproc'] = 1 # number of processes for reading the density files (rassi)
+        self['lvprt'] = 1 # verbosity of the density parsers (rassi: 2 prints the large density elements)
         
         # Output options
         self['output_file']   = "ana_summ.txt"
@@ -380,6 +387,8 @@ class dens_ana_options(read_options):
         self['alphabeta'] = False # use alpha/beta rather than neg./pos. to code for hole/electron?
         self['mcfmt']          = '% 10E' # format for molden coefficients
         self['output_prec']   = (7,3) # number of digits and decimal digits for output summary
+        self['output_bin'] = False # write the summary also as <output_file>.npz with full precision
+        self['prof_file'] = None # write timings and memory usage per stage and state to this JSON file
         
         # Additional information
         # irrep labels for output
@@ -415,6 +424,7 @@ class tden_ana_options(dens_ana_options):
         self['at_lists'] = None
         self['prop_list'] = ['Om', 'POS', 'PR', 'CT', 'COH', 'CTnt']
         self['print_OmFrag'] = True # print out the Omega matrix
+        self['bas_lists'] = None # groups of basis functions, e.g. [[(1, 'd')], [(2, 'p'), (3, 'p')]], or 'shells', 'l'
         
         # program flow
         self['comp_ntos'] = True
@@ -0,0 +1,225 @@
+"""
+On-disk storage of per-state results for incremental re-analysis.
+The results are written into a compressed numpy .npz file, which is keyed by
+fingerprints of the input files and of the relevant options.
+"""
+
+import lib_state
+import numpy
+import os, glob, hashlib
+
+# Additional files that are read, depending on the rtype
+rtype_globs = {
+    'ricc2': ['CCRE0-*'],
+    'tddft': ['sing_*', 'trip_*', 'ciss_*', 'cist_*'],
+    'escf': ['sing_*', 'trip_*', 'ciss_*', 'cist_*'],
+    'tmtddft': ['sing_*', 'trip_*', 'ciss_*', 'cist_*'],
+    'libwfa': ['*.om'],
+    'qcadc': ['*.om'],
+    'qctddft': ['*.om'],
+    'mrci': ['LISTINGS/trncils*'],
+    'colmrci': ['LISTINGS/trncils*'],
+    'mcscf': ['WORK/*d1fl*'],
+    'colmcscf': ['WORK/*d1fl*'],
+    }
+
+# Options that determine which states and densities are read
+read_keys = ['rtype', 'rfile', 'mo_file', 'ana_files', 'read_binary', 'read_libwfa', 's_or_t',
+             'ignore_irreps', 'irrep_labels', 'ncore', 'TDA']
+
+def ret_file_hash(fname, blocksize=2**20):
+    """
+    Return the SHA1 hash of the content of a file.
+    """
+    sha = hashlib.sha1()
+    try:
+        with open(fname, 'rb') as f:
+            while True:
+                block = f.read(blocksize)
+                if len(block) == 0: break
+                sha.update(block)
+    except IOError:
+        return 'missing'
+
+    return sha.hexdigest()
+
+def ret_input_files(ioptions):
+    """
+    Return a list of all files that are (possibly) read for the analysis.
+    """
+    file_list = []
+    for key in ['mo_file', 'rfile']:
+        if key in ioptions: file_list.append(ioptions[key])
+    file_list += ioptions['ana_files']
+
+    rtype = ioptions.get('rtype', strict=False)
+    for pattern in rtype_globs.get(rtype, []):
+        file_list += sorted(glob.glob(pattern))
+
+    return file_list
+
+def ret_fingerprint(ioptions, keys, file_list=[]):
+    """
+    Return a fingerprint of the options in keys and the contents of the files in file_list.
+    """
+    sha = hashlib.sha1()
+    for key in keys:
+        sha.update(('%s=%s\n'%(key, repr(ioptions.opt_dict.get(key)))).encode())
+    for fname in file_list:
+        sha.update(('%s:%s\n'%(fname, ret_file_hash(fname))).encode())
+
+    return sha.hexdigest()
+
+class state_cache:
+    """
+    Storage of per-state results in a compressed .npz file.
+    The file contains
+        - one fingerprint for every stage (fp_<stage>)
+        - the state names
+        - scalar state properties (col_<key>) and the corresponding masks (mask_<key>)
+        - stacked arrays (arr_<key>), which are padded with nan if their shapes differ
+    """
+    def __init__(self, fname):
+        self.fname = fname
+
+    def write(self, state_list, fps, stage_keys):
+        """
+        Write the data of the states in state_list.
+        fps: dictionary with the fingerprints of the stages
+        stage_keys: dictionary with the stage of every computed entry,
+            all other scalar (number or string) entries are assigned to the 'states' stage
+        Only the arrays listed in stage_keys are stored.
+        """
+        data = {}
+        table = isinstance(state_list, lib_state.state_table)
+        if table:
+            data['names'] = numpy.array(state_list.ret_col('name')[0].tolist())
+        else:
+            data['names'] = numpy.array([state['name'] for state in state_list])
+        stages = set(['states'])
+
+        scalar_keys = []
+        if table:
+            # the scalar entries are stored column-wise already
+            scalar_keys = [key for key in state_list.ret_scalar_keys() if key != 'name']
+        else:
+            for state in state_list:
+                for key, val in state.items():
+                    if key == 'name' or key in scalar_keys: continue
+                    if isinstance(val, (str, int, float, numpy.integer, numpy.floating)):
+                        scalar_keys.append(key)
+
+        for key in scalar_keys:
+            if table:
+                tcol, mask = state_list.ret_col(key)
+                kind = tcol.dtype.kind
+                vals = tcol[mask]
+            else:
+                mask = numpy.array([key in state for state in state_list], dtype=bool)
+                kind = 'O'
+                vals = [state[key] for state in state_list if key in state]
+
+            if kind == 'O':
+                if all(isinstance(val, str) for val in vals):
+                    kind = 'U'
+                elif all(isinstance(val, (int, numpy.integer)) for val in vals):
+                    kind = 'i'
+                elif all(isinstance(val, (int, float, numpy.integer, numpy.floating)) for val in vals):
+                    kind = 'f'
+                else:
+                    # mixed types are not stored
+                    continue
+
+            if kind == 'U':
+                col = numpy.empty(len(mask), dtype=object)
+                col[:] = ''
+                col[mask] = vals
+                col = numpy.array(col.tolist())
+            elif kind in ['b', 'i']:
+                col = numpy.zeros(len(mask), dtype=int)
+                col[mask] = vals
+            else:
+                col = numpy.zeros(len(mask))
+                col[:] = numpy.nan
+                col[mask] = vals
+            stages.add(stage_keys.get(key, 'states'))
+            data['col_%s'%key] = col
+            data['mask_%s'%key] = mask
+
+        for key, stage in stage_keys.items():
+            if key in scalar_keys: continue
+
+            if table:
+                arrs = state_list.ret_arrs(key)
+            else:
+                arrs = [state[key] if key in state else None for state in state_list]
+            mask = numpy.array([arr is not None for arr in arrs], dtype=bool)
+            if not mask.any(): continue
+            stages.add(stage)
+
+            arrs = [None if arr is None else numpy.asarray(arr, dtype=float) for arr in arrs]
+            shape = numpy.max([arr.shape for arr in arrs if arr is not None], axis=0)
+            stack = numpy.zeros([len(arrs)] + list(shape))
+            stack[:] = numpy.nan
+            for istate, arr in enumerate(arrs):
+                if arr is None: continue
+                stack[(istate,) + tuple(slice(0, n) for n in arr.shape)] = arr
+
+            data['arr_%s'%key] = stack
+            data['amask_%s'%key] = mask
+            data['ashape_%s'%key] = numpy.array([shape if arr is None else arr.shape for arr in arrs], dtype=int)
+
+        # only the fingerprints of stages that were actually computed are written
+        for stage, fp in fps.items():
+            if stage in stages: data['fp_%s'%stage] = numpy.array(fp)
+
+        numpy.savez_compressed(self.fname, **data)
+
+    def read(self, fps, stage_keys):
+        """
+        Read the states from the cache file.
+        Only the entries of stages whose fingerprints agree with fps are considered.
+        stage_keys: dictionary with the stage of every computed entry
+        Return the state list, and the list of valid stages, or (None, []) if
+        the cache cannot be used at all.
+        """
+        if not os.path.exists(self.fname): return None, []
+
+        try:
+            data = numpy.load(self.fname, allow_pickle=False)
+        except Exception:
+            print(" WARNING: cannot read cache file %s"%self.fname)
+            return None, []
+
+        valid = []
+        for stage, fp in fps.items():
+            if 'fp_%s'%stage in data.files and str(data['fp_%s'%stage]) == fp:
+                valid.append(stage)
+
+        if not 'states' in valid: return None, []
+
+        state_list = lib_state.state_table()
+        for name in data['names']:
+            state_list.append({'name': str(name)})
+        for dkey in data.files:
+            if dkey.startswith('col_'):
+                key = dkey[4:]
+                if not stage_keys.get(key, 'states') in valid: continue
+
+                col, mask = data[dkey], data['mask_%s'%key]
+                for istate, state in enumerate(state_list):
+                    if not mask[istate]: continue
+                    state[key] = col[istate].item()
+
+            elif dkey.startswith('arr_'):
+                key = dkey[4:]
+                if not stage_keys.get(key) in valid: continue
+
+                stack, mask, shapes = data[dkey], data['amask_%s'%key], data['ashape_%s'%key]
+                for istate, state in enumerate(state_list):
+                    if not mask[istate]: continue
+                    state[key] = stack[(istate,) + tuple(slice(0, n) for n in shapes[istate])].copy()
+
+        data.close()
+
+        return state_list, valid
@@ -19,7 +19,7 @@ class exciton_analysis:
         """
         Return the root mean square electron-hole distance (Ang).
         """
-        if self.distmat == None:
+        if self.distmat is None:
             raise error_handler.MsgError("Compute the distance matrix first!")
         
         MS_dist = numpy.dot(OmAt.flatten(), self.distmat.flatten()**2.) / Om
@@ -32,7 +32,7 @@ class exciton_analysis:
         """
         Return the mean absolute electron-hole distance (Ang).
         """
-        if self.distmat == None:
+        if self.distmat is None:
             raise error_handler.MsgError("Compute the distance matrix first!")
         
         MA_dist = numpy.dot(OmAt.flatten(), self.distmat.flatten()) / Om
@@ -43,7 +43,7 @@ class exciton_analysis:
         """
         Return an approximate exciton binding energy (eV).
         """
-        if self.distmat == None:
+        if self.distmat is None:
             raise error_handler.MsgError("Compute the distance matrix first!")
         
         Eb_dist = self.distmat.flatten() / units.length['A']
@@ -1,4 +1,5 @@
 import error_handler
+import numpy
 
 """
 General file manipulation classes.
@@ -48,7 +49,8 @@ class wtable:
         self.ncol = ncol
         self.icol = 0
         
-        self.str = self.init_extra()
+        # the pieces of the table are collected in a list and joined at the end
+        self.buf = [self.init_extra()]
         
     def init_extra(self):
         return ''
@@ -58,10 +60,10 @@ class wtable:
         Add an element
         """
         if self.icol == self.ncol:
-            self.str += self.new_row()
+            self.buf.append(self.new_row())
             self.icol = 0
         
-        self.str += self.new_el(el)
+        self.buf.append(self.new_el(el))
         
         self.icol += 1
         
@@ -83,10 +85,23 @@ class wtable:
     def new_el(self, el):
         raise error_handler.PureVirtualError()
     
+    def flush(self, fileh):
+        """
+        Write the part of the table collected so far to fileh and empty the buffer.
+        This allows to stream large tables to a file.
+        """
+        fileh.write(''.join(self.buf))
+        self.buf = []
+    
     def ret_table(self):
-        self.str += self.close_table()
+        """
+        Return the (remaining part of the) table.
+        """
+        self.buf.append(self.close_table())
         
-        return self.str
+        ret_str = ''.join(self.buf)
+        self.buf = []
+        return ret_str
         
     def close_table(self):
         raise error_handler.PureVirtualError()
@@ -179,46 +194,84 @@ class latextable(wtable):
 class summ_file:
     """
     Class for analyzing the summary files.
+    Binary summaries (<output_file>.npz, see output_bin) are read if the .npz file is given.
     """
     def __init__(self, fname):
-        self.ddict = {}
+        self.ddict = None
+        self.cols = {}
         self.state_labels = []
         
-#       try:
+        if fname.endswith('.npz'):
+            self.read_bin(fname)
+        else:
+            self.read_txt(fname)
+            
+    def read_bin(self, bname):
+        """
+        Read the columns from the .npz file.
+        """
+        data = numpy.load(bname, allow_pickle=False)
+        
+        self.header = [str(prop) for prop in data['header']]
+        self.state_labels = [str(state) for state in data['state']]
+        for icol, prop in enumerate(self.header[1:]):
+            self.cols[prop] = data['c%i'%(icol+1)]
+            
+        data.close()
+        
+    def read_txt(self, fname):
+        """
+        Read the columns from the text file. Entries that cannot be converted are set to nan.
+        """
         f = open(fname, 'r')
-#        except IOError:
-#            print ' WARNING: file %s not found!'%fname
-#            self.header = ''
-#            return
         
-        self.header = f.next().split()
+        self.header = next(f).split()
         next(f)
         
-        while True:
+        rows = []
+        for line in f:
+            words = line.split()
+            if len(words) == 0: continue
+            
+            self.state_labels.append(words[0])
+            row = []
+            for i in range(1, len(self.header)):
                 try:
-                    line = next(f)
-                except StopIteration:
-                    break
-                
-                words = line.split()
-                self.ddict[words[0]] = {}
-                pdict = self.ddict[words[0]]
-                self.state_labels.append(words[0])
-                
-                for i, prop in enumerate(self.header[1:]):
-                    try:
-                        pdict[prop] = float(words[i+1])
-                    except ValueError:
-                        pass
+                    row.append(float(words[i]))
+                except (ValueError, IndexError):
+                    row.append(numpy.nan)
+            rows.append(row)
         
         f.close()
         
+        vals = numpy.array(rows, dtype=float).reshape(len(rows), len(self.header)-1)
+        for icol, prop in enumerate(self.header[1:]):
+            self.cols[prop] = vals[:, icol]
+        
     def ret_header(self):
         return self.header
     
+    def ret_col(self, prop):
+        """
+        Return the values of one property for all states as a numpy array.
+        """
+        return self.cols[prop]
+    
     def ret_ddict(self):
+        """
+        Return a dictionary [state_label][prop] with all numerical entries that are available.
+        """
+        if self.ddict is None:
+            self.ddict = {}
+            for state in self.state_labels:
+                self.ddict[state] = {}
+                
+            for prop, col in self.cols.items():
+                if col.dtype.kind != 'f': continue
+                for state, val in zip(self.state_labels, col.tolist()):
+                    if val == val: self.ddict[state][prop] = val
+                    
         return self.ddict
     
     def ret_state_labels(self):
         return self.state_labels
-    
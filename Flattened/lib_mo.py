@@ -2,8 +2,14 @@
 Handling and manipulation of MO-coefficients.
 """
 
-import error_handler, lib_file
+import error_handler, lib_file, lib_partition, lib_prof
 import numpy
+import hashlib
+
+# Basis function tables of the Molden files read so far, keyed by a hash of the [GTO] section.
+#   The tables are shared between MO_set instances and must not be modified.
+basis_cache = {}
+basis_cache_size = 8
 
 class MO_set:
     """
@@ -14,11 +20,15 @@ class MO_set:
         
         self.header = '' # header info for print-out
         self.num_at = 0
-        self.basis_fcts = [] # info about basis functions
+        self.basis_fcts = basis_fct_table() # info about basis functions
         
         self.S = None
         self.mo_mat = None
         self.inv_mo_mat = None
+        self.sparse = False # mo_mat is stored as a scipy.sparse CSR matrix
+        self.dtype = numpy.float64 # precision of mo_mat and inv_mo_mat
+        self.label_inds = {} # lookup tables label -> MO index for the label lists (see ret_imo)
+        self.perm = None # MO i in the current order is MO perm[i] in the order of the file (see permute)
     
     def read(self, *args, **kwargs):
         """
@@ -26,6 +36,7 @@ class MO_set:
         """
         raise error_handler.PureVirtualError()
            
+    @lib_prof.profile()
     def compute_inverse(self, lvprt=1):
         """
         Compute the inverse of the MO matrix.
@@ -33,30 +44,52 @@ class MO_set:
         """
         
         # Preferably, the overlap matrix should be used to avoid explicit inversion
-        if not self.S == None:
+        if not self.S is None:
             if lvprt >= 1:
                 print(" ... inverse computed as: C^T.S")
-            self.inv_mo_mat = numpy.dot(self.mo_mat.transpose(), self.S)
-        elif len(self.mo_mat) == len(self.mo_mat[0]):
+            self.inv_mo_mat = numpy.asarray(self.mo_mat.transpose() @ self.S, dtype=self.dtype)
+            return
+        
+        # the inverse of a sparse matrix is dense in general
+        #   the inversion is always done in double precision
+        mo_mat = self.mo_mat.toarray() if self.sparse else self.mo_mat
+        mo_mat = mo_mat.astype(numpy.float64, copy=False)
+        if self.ret_num_bas() == self.ret_num_mo():
             if lvprt >= 1:
                 print(" ... inverting C")
             try:
-                self.inv_mo_mat = numpy.linalg.inv(self.mo_mat)
+                self.inv_mo_mat = numpy.linalg.inv(mo_mat)
             except:
                 if lvprt >= 1:
                     print(" WARNING: inversion failed.")
                     print('  Using the Moore-Penrose pseudo inverse instead.')
-                self.inv_mo_mat = numpy.linalg.pinv(self.mo_mat)
+                self.inv_mo_mat = numpy.linalg.pinv(mo_mat)
         else:
             if lvprt >= 1:
-                print('MO-matrix not square: %i x %i'%(len(self.mo_mat),len(self.mo_mat[0])))
+                print('MO-matrix not square: %i x %i'%(self.ret_num_bas(), self.ret_num_mo()))
                 print('  Using the Moore-Penrose pseudo inverse instead.')
-            self.inv_mo_mat = numpy.linalg.pinv(self.mo_mat)
+            self.inv_mo_mat = numpy.linalg.pinv(mo_mat)
+            
+        self.inv_mo_mat = self.inv_mo_mat.astype(self.dtype, copy=False)
+    
+    def set_dtype(self, dtype):
+        """
+        Set the precision in which the MO matrix and its inverse are stored (float64 or float32).
+        """
+        self.dtype = numpy.dtype(dtype).type
+        
+        self.mo_mat = self.mo_mat.astype(self.dtype, copy=False)
+        if not self.inv_mo_mat is None:
+            self.inv_mo_mat = self.inv_mo_mat.astype(self.dtype, copy=False)
     
     def ret_mo_mat(self, trnsp=False, inv=False):
         """
         Return the MO matrix, possibly transposed and/or inverted.
+        The inverse is computed when it is first needed.
         """
+        if inv and self.inv_mo_mat is None:
+            self.compute_inverse()
+            
         if not trnsp and not inv:
             return self.mo_mat
         elif trnsp and not inv:
@@ -74,10 +107,10 @@ class MO_set:
         return self.occs.index(0.) - 1
     
     def ret_num_mo(self):
-        return len(self.mo_mat[0])
+        return self.mo_mat.shape[1]
     
     def ret_num_bas(self):
-        return len(self.mo_mat)
+        return self.mo_mat.shape[0]
     
     def ret_eo(self, imo):
         return self.ens[imo], self.occs[imo]
@@ -89,6 +122,30 @@ class MO_set:
             print("\nNo entry for imo=%i"%imo)
             raise
     
+    def ret_imo(self, label, key='syms'):
+        """
+        Return the index of the MO with the given label in the list self.<key>
+            (syms or a variant like the Columbus labels syms2).
+        The lookup table is built at the first call and whenever a new list is assigned.
+        Raise KeyError if the label is not found.
+        """
+        labels = getattr(self, key)
+        if not key in self.label_inds or not self.label_inds[key][0] is labels:
+            self.set_label_index(key)
+            
+        return self.label_inds[key][1][label]
+        
+    def set_label_index(self, key='syms'):
+        """
+        Build the lookup table for the labels in self.<key>.
+        For repeated labels the first MO is taken.
+        """
+        labels = getattr(self, key)
+        inds = {}
+        for imo, label in enumerate(labels):
+            inds.setdefault(label, imo)
+        self.label_inds[key] = (labels, inds)
+        
     def set_ens_occs(self):
         """
         In the case of Q-Chem the occupations are actually written into the energy field.
@@ -101,10 +158,10 @@ class MO_set:
         Right-multiplication of matrix M with the MO-coefficients.
         """
         try:
-            return numpy.dot(M, self.ret_mo_mat(trnsp, inv))
+            return M @ self.ret_mo_mat(trnsp, inv)
         except:
-            print("M: %i x %i"%(len(M), len(M[0])))
-            print("C: %i x %i"%(len(self.ret_mo_mat(trnsp, inv)), len(self.ret_mo_mat(trnsp, inv)[0])))
+            print("M: %i x %i"%M.shape)
+            print("C: %i x %i"%self.ret_mo_mat(trnsp, inv).shape)
             raise
     
     def CdotD(self, D, trnsp=False, inv=False):
@@ -113,18 +170,18 @@ class MO_set:
         Optionally, D can be a rectangular matrix of dimension occ x (occ + virt).
         """       
         if self.ret_num_mo() == len(D):
-            return numpy.dot(self.ret_mo_mat(trnsp, inv), D)
+            return self.ret_mo_mat(trnsp, inv) @ D
         
         # Handling of special cases
         elif self.ret_num_mo() > len(D):
             if not trnsp and not inv:
                 # take only the occ. subblock
                 Csub = self.mo_mat.transpose()[:len(D)]
-                return numpy.dot(Csub.transpose(), D)
+                return Csub.transpose() @ D
             elif trnsp and inv:
                 # take only the occ. subblock
-                Csub = self.inv_mo_mat[:len(D)]
-                return numpy.dot(Csub.transpose(), D)            
+                Csub = self.ret_mo_mat(trnsp=False, inv=True)[:len(D)]
+                return Csub.transpose() @ D
             else:
                 raise error_handler.ElseError('"transpose xor inverse"', 'CdotD')
             
@@ -135,7 +192,7 @@ class MO_set:
 #                raise error_handler.ElseError('C < D', 'MO matrix')
 
                 Dsub = D[:self.ret_num_mo()]
-                return numpy.dot(self.ret_mo_mat(trnsp, inv), Dsub)
+                return self.ret_mo_mat(trnsp, inv) @ Dsub
     
     def export_MO(self, ens, occs, U, *args, **kwargs):
         """
@@ -182,8 +239,6 @@ class MO_set:
                     else:
                         occorbs[il].append((sym, imo))
                         
-        T = numpy.zeros([self.ret_num_mo(), self.ret_num_mo()], int)
-        
         orblist = []
         if sepov:
             for il in irrep_labels:
@@ -193,17 +248,45 @@ class MO_set:
         else:
             raise error_handler.ElseError('False', 'sepov')
         
-        self.syms = []
-        for jmo, orb in enumerate(orblist):
-            T[jmo, orb[1]] = 1
-            self.syms.append(orb[0])
+        # new MO jmo is the old MO perm[jmo]
+        perm = numpy.array([orb[1] for orb in orblist], dtype=int)
+        if not numpy.array_equal(numpy.sort(perm), numpy.arange(self.ret_num_mo())):
+            raise error_handler.MsgError("symsort: the irreps %s do not assign every MO exactly once"%irrep_labels)
+        
+        self.permute(perm)
         
-        assert(jmo==self.ret_num_mo()-1)
+    def permute(self, perm):
+        """
+        Reorder the MOs: the new MO jmo is the old MO perm[jmo].
+        """
+        self.syms = [self.syms[imo] for imo in perm]
+        self.ens  = [self.ens[imo] for imo in perm]
+        self.occs = [self.occs[imo] for imo in perm]
+        # a new table since copies of this MO_set may share the old one
+        self.label_inds = {}
+        self.set_label_index()
+        
+        # the columns of C and the rows of its inverse are permuted, the CSR format is kept
+        self.mo_mat = self.mo_mat[:, perm]
+        if not self.inv_mo_mat is None:
+            self.inv_mo_mat = self.inv_mo_mat[perm, :]
+            
+        self.perm = perm if self.perm is None else self.perm[perm]
+        
+    def ret_perm(self, inv=False):
+        """
+        Return the MO permutation applied by symsort/permute as an index array:
+            current index -> index in the MO file, or the inverse for inv=True.
+        """
+        perm = numpy.arange(self.ret_num_mo()) if self.perm is None else self.perm
+        if not inv: return perm
         
-        self.mo_mat = numpy.dot(self.mo_mat, T.transpose())
-        self.compute_inverse()
+        iperm = numpy.empty_like(perm)
+        iperm[perm] = numpy.arange(len(perm))
+        return iperm
 
 class MO_set_molden(MO_set):
+    @lib_prof.profile()
     def export_AO(self, ens, occs, Ct, fname='out.mld', cfmt='% 10E', occmin=-1, alphabeta=False):
         """
         Export coefficients given already in the AO basis to molden file.
@@ -235,15 +318,26 @@ class MO_set_molden(MO_set):
         
         mld.close()
         
-    def read(self, lvprt=1):
+    @lib_prof.profile()
+    def read(self, lvprt=1, sparse=False):
         """
         Read in MO coefficients from a molden File.
+        
+        The coefficients are placed according to the basis function index given
+        in the first column. Therefore, files where zero coefficients are omitted
+        can be read as well.
+        sparse=True stores the MO matrix in CSR format (requires scipy).
         """
         
         MO = False
         GTO = False
-        mo_vecs = []
-        mo_ind = 0
+        # coefficients in coordinate format: basis function index, MO index, value
+        bas_inds = []
+        mo_inds  = []
+        coeffs   = []
+        mo_nentry = [] # number of entries read for every MO
+        mo_ind = -1
+        gto_lines = []
         self.syms = [] # list with the orbital descriptions. they are entered after Sym in the molden file.
         self.occs = [] # occupations
         self.ens  = [] # orbital energies (or whatever is written in that field)
@@ -261,6 +355,9 @@ class MO_set_molden(MO_set):
         curr_at=-1
 
         self.header = ''
+        # a new table, since the previous one may be shared through basis_cache
+        self.basis_fcts = basis_fct_table()
+        self.num_at = 0
         
         fileh = open(self.file, 'r')
         
@@ -300,16 +397,19 @@ class MO_set_molden(MO_set):
             elif MO:
                 if not '=' in line:
                     try:
-                        mo_vecs[-1].append(float(words[1]))
+                        bas_inds.append(int(words[0]) - 1)
+                        coeffs.append(float(words[1]))
                     except:
                         if words==[]: break # stop parsing the file if an empty line is found
 
                         print(" ERROR in lib_mo, parsing the following line:")
                         print(line)
                         raise
+                    mo_inds.append(mo_ind)
+                    mo_nentry[-1] += 1
                 elif 'ene' in line.lower():
                     mo_ind += 1
-                    mo_vecs.append([])
+                    mo_nentry.append(0)
                     self.ens.append(float(words[-1]))
                 elif 'sym' in line.lower():
                     self.syms.append(words[-1])
@@ -318,8 +418,23 @@ class MO_set_molden(MO_set):
                         
             elif ('[GTO]' in line):
                 GTO = True
-                # extract the information in that section
+                # the section is interpreted after parsing
             elif GTO:
+                gto_lines.append(line)
+
+            if not MO:
+                self.header += line
+                
+        fileh.close()
+        
+        # extract the basis function information from the [GTO] section
+        #   the result is reused for files with the same basis set
+        gto_key = hashlib.sha1((repr(num_bas) + ''.join(gto_lines)).encode()).hexdigest()
+        if gto_key in basis_cache:
+            self.basis_fcts, num_orb, self.num_at = basis_cache[gto_key]
+        else:
+            for line in gto_lines:
+                words = line.replace('=',' ').split()
                 if len(words)==0: # empty line: atom is finished
                     curr_at = -1
                 elif curr_at==-1:
@@ -328,34 +443,53 @@ class MO_set_molden(MO_set):
                 elif (len(words) >= 2) and (words[0].lower() in num_bas):
                   orbsymb = words[0].lower()
                   
-                  for i in range(num_bas[orbsymb]):
-                    self.basis_fcts.append(basis_fct(curr_at, orbsymb, orient[orbsymb][i]))
-                    num_orb+=1
-
-            if not MO:
-                self.header += line
-                
-        fileh.close()
+                  self.basis_fcts.add_shell(curr_at, orbsymb, orient[orbsymb])
+                  num_orb+=num_bas[orbsymb]
+                  
+            if len(basis_cache) >= basis_cache_size: basis_cache.pop(next(iter(basis_cache)))
+            basis_cache[gto_key] = (self.basis_fcts, num_orb, self.num_at)
 
 ### file parsing finished ###
 
-        if lvprt >= 1 or len(mo_vecs[0])!=num_orb:
+        num_mo = len(mo_nentry)
+        if len(coeffs) == 0:
+            raise error_handler.MsgError('No MO coefficients found in %s!'%self.file)
+        
+        bas_inds = numpy.array(bas_inds, dtype=int)
+        max_ind = bas_inds.max() + 1
+        ind_err = max_ind > num_orb or bas_inds.min() < 0
+        
+        if lvprt >= 1 or ind_err:
             print('\nMO file %s parsed.'%self.file)
             print('Number of atoms: %i'%self.num_at)
-            print('Number of MOs read in: %i'%len(mo_vecs))
-            print('Dimension: %i,%i,...,%i'%(len(mo_vecs[0]),len(mo_vecs[1]),len(mo_vecs[-1])))
+            print('Number of MOs read in: %i'%num_mo)
+            print('Dimension: %i,%i,...,%i'%(mo_nentry[0],mo_nentry[1],mo_nentry[-1]))
             print('Number of basis functions parsed: ', num_orb)
+            if len(coeffs) < num_mo * num_orb:
+                print('Number of explicit coefficients: %i of %i'%(len(coeffs), num_mo * num_orb))
         
-        if len(mo_vecs[0])!=num_orb:
+        if ind_err:
+            print("\n *** Unable to construct MO matrix! ***")
+            print("Basis function index %i found but only %i basis functions parsed."%(max_ind, num_orb))
+            print("Is there a mismatch between spherical/cartesian functions?\n ---")
             raise error_handler.MsgError('Inconsistent number of basis functions!')
-
-        try:
-           self.mo_mat = numpy.array(mo_vecs).transpose()
-        except ValueError:
-           print("\n *** Unable to construct MO matrix! ***")
-           print("Is there a mismatch between spherical/cartesian functions?\n ---")
-           raise
         
+        # scatter the coefficients into the MO matrix, omitted entries remain zero
+        if sparse:
+            try:
+                import scipy.sparse
+            except ImportError:
+                print("\n ERROR: Did not find the external scipy package!")
+                print("Please, install scipy to use sparse MO storage.\n")
+                raise
+            
+            self.mo_mat = scipy.sparse.csr_matrix((coeffs, (bas_inds, mo_inds)), shape=(num_orb, num_mo))
+            self.sparse = True
+            if lvprt >= 1:
+                print('MO matrix stored in sparse format (%i non-zero entries)'%self.mo_mat.nnz)
+        else:
+            self.mo_mat = numpy.zeros([num_orb, num_mo])
+            self.mo_mat[bas_inds, mo_inds] = coeffs
 
       
 class basis_fct:
@@ -366,6 +500,141 @@ class basis_fct:
         self.at_ind = at_ind # atom where the function is located
         self.l = l   # s, p, d, f
         self.ml = ml # x, y, z
+
+class basis_fct_table:
+    """
+    Columnar storage of the basis function information.
+    For every basis function the atom index (starting with 1), the angular momentum,
+    a component code, and the shell index are stored in a structured numpy array.
+    The columns can be accessed as arrays (e.g. basis_fcts.at_ind) to construct
+    vectorized masks. For compatibility, indexing returns basis_fct instances.
+    """
+    dtype = numpy.dtype([('at_ind', numpy.int32), ('l', numpy.int8), ('ml', numpy.int16), ('shell', numpy.int32)])
+    l_codes = {'s':0, 'p':1, 'd':2, 'f':3, 'g':4, 'h':5}
+    
+    def __init__(self):
+        self.data = numpy.zeros(16, self.dtype)
+        self.nbas = 0
+        
+        self.shell_types = [] # shell labels as given in the input (s, p, sp, d, ...)
+        self.ml_labels = []   # labels of the components, referenced by the ml column
+        self.ml_codes = {}
+        
+        self.at_part = None # cached partition into atoms
+        
+    def __len__(self):
+        return self.nbas
+    
+    def __getitem__(self, ibas):
+        """
+        Return a basis_fct instance for backwards compatibility.
+        """
+        if ibas < 0: ibas += self.nbas
+        if not 0 <= ibas < self.nbas:
+            raise IndexError('basis function index out of range: %i'%ibas)
+        
+        row = self.data[ibas]
+        return basis_fct(int(row['at_ind']), self.shell_types[row['shell']], self.ml_labels[row['ml']])
+        
+    def __iter__(self):
+        for ibas in range(self.nbas):
+            yield self[ibas]
+            
+    def append(self, bfct):
+        """
+        Add a single basis_fct, as done for a list.
+        """
+        self.add_shell(bfct.at_ind, bfct.l, [bfct.ml])
+    
+    def add_shell(self, at_ind, shell_type, ml_list):
+        """
+        Add a shell with one basis function for every entry in ml_list.
+        shell_type is the label of the shell (s, p, sp, d, ...).
+        """
+        nnew = len(ml_list)
+        if self.nbas + nnew > len(self.data):
+            self.data = numpy.resize(self.data, 2 * (self.nbas + nnew))
+            
+        new = self.data[self.nbas:self.nbas + nnew]
+        new['at_ind'] = at_ind
+        new['shell']  = len(self.shell_types)
+        new['ml'] = [self.ret_ml_code(ml) for ml in ml_list]
+        if shell_type == 'sp':
+            # the first function is of s type, the others of p type
+            new['l'] = [0] + (nnew-1) * [1]
+        else:
+            new['l'] = self.l_codes.get(shell_type, -1)
+        
+        self.shell_types.append(shell_type)
+        self.nbas += nnew
+        
+    def ret_ml_code(self, ml):
+        if not ml in self.ml_codes:
+            self.ml_codes[ml] = len(self.ml_labels)
+            self.ml_labels.append(ml)
+        return self.ml_codes[ml]
+    
+    @property
+    def at_ind(self):
+        return self.data['at_ind'][:self.nbas]
+    
+    @property
+    def l(self):
+        return self.data['l'][:self.nbas]
+    
+    @property
+    def ml(self):
+        return self.data['ml'][:self.nbas]
+    
+    @property
+    def shell(self):
+        return self.data['shell'][:self.nbas]
+    
+    def ret_mask(self, at_ind=None, l=None):
+        """
+        Return a boolean mask of the basis functions on the atom(s) at_ind
+        with angular momentum l, e.g. ret_mask(5, 'd') for all d functions on atom 5.
+        Both arguments may be single values or lists, None selects all functions.
+        """
+        mask = numpy.ones(self.nbas, bool)
+        if not at_ind is None:
+            mask &= numpy.isin(self.at_ind, at_ind)
+        if not l is None:
+            if isinstance(l, (str, int)): l = [l]
+            lcodes = [self.l_codes[il] if isinstance(il, str) else il for il in l]
+            mask &= numpy.isin(self.l, lcodes)
+        return mask
+    
+    def ret_at_partition(self, num_at):
+        """
+        Return the partition of the basis functions into atoms.
+        """
+        if self.at_part is None or self.at_part.nbas != self.nbas or self.at_part.ngroup != num_at:
+            self.at_part = lib_partition.ret_atom_partition(self, num_at)
+        return self.at_part
+    
+    def ret_at_pop(self, vec, num_at):
+        """
+        Sum the entries of vec over the basis functions of every atom.
+        """
+        return self.ret_at_partition(num_at).reduce_vec(vec)
+        
+    def ret_at_mat(self, M, num_at):
+        """
+        Sum the blocks of the matrix M over the basis functions of every pair of atoms.
+        """
+        return self.ret_at_partition(num_at).reduce_mat(M)
+        
+    def same_layout(self, other):
+        """
+        Check if two tables describe the same basis functions (atoms, angular momenta, components).
+        """
+        if self is other: return True
+        if len(self) != len(other): return False
+        
+        for key in ['at_ind', 'l', 'ml']:
+            if not numpy.array_equal(getattr(self, key), getattr(other, key)): return False
+        return True
         
 class jmol_MOs:
     """
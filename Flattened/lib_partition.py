@@ -0,0 +1,144 @@
+"""
+Partitioning of the basis functions into groups (atoms, shells, angular momentum
+channels, or user-defined subsets) and reduction of matrices over these groups.
+"""
+
+import error_handler
+import numpy
+
+class partition:
+    """
+    Grouping of basis functions, which is represented by a sparse projector matrix P
+    with P_iA = 1 if basis function i belongs to group A.
+    The projector is stored in coordinate format sorted by groups, and
+    the reduction M_AB = sum_ij P_iA M_ij P_jB is carried out with numpy.add.reduceat.
+    The groups may overlap and do not have to cover all basis functions.
+    """
+    def __init__(self, nbas, group_list, labels=None):
+        """
+        nbas: number of basis functions
+        group_list: list with an index array (starting with 0) of the basis functions for every group
+        labels: names of the groups
+        """
+        self.nbas = nbas
+        self.ngroup = len(group_list)
+        if labels is None:
+            labels = ['%i'%(igroup+1) for igroup in range(self.ngroup)]
+        self.labels = labels
+
+        sizes = numpy.array([len(group) for group in group_list], dtype=int)
+        if sizes.sum() > 0:
+            self.bas_inds = numpy.concatenate([numpy.asarray(group, dtype=int) for group in group_list])
+        else:
+            self.bas_inds = numpy.zeros(0, dtype=int)
+        self.group_inds = numpy.repeat(numpy.arange(self.ngroup), sizes)
+
+        if len(self.bas_inds) > 0 and (self.bas_inds.min() < 0 or self.bas_inds.max() >= nbas):
+            raise error_handler.MsgError('Basis function index out of range in partition')
+
+        # empty groups have to be skipped in reduceat
+        self.groups = numpy.flatnonzero(sizes > 0)
+        self.starts = (numpy.cumsum(sizes) - sizes)[self.groups]
+
+        # no reordering is needed if every basis function appears exactly once in ascending order
+        self.ident = len(self.bas_inds) == nbas and numpy.all(self.bas_inds == numpy.arange(nbas))
+
+    def ret_proj_mat(self):
+        """
+        Return the projector as a scipy.sparse CSR matrix or, if scipy is not available, as a dense array.
+        """
+        try:
+            import scipy.sparse
+        except ImportError:
+            P = numpy.zeros([self.nbas, self.ngroup])
+            P[self.bas_inds, self.group_inds] = 1.
+            return P
+
+        return scipy.sparse.csr_matrix((numpy.ones(len(self.bas_inds)), (self.bas_inds, self.group_inds)),
+                                       shape=(self.nbas, self.ngroup))
+
+    def reduce_vec(self, vec):
+        """
+        Sum the entries of a vector over the groups.
+        """
+        ret_vec = numpy.zeros(self.ngroup)
+        if len(self.groups) == 0: return ret_vec
+
+        if not self.ident: vec = vec[self.bas_inds]
+        ret_vec[self.groups] = numpy.add.reduceat(vec, self.starts, dtype=numpy.float64)
+        return ret_vec
+
+    def reduce_mat(self, M):
+        """
+        Sum the blocks of the matrix M over all pairs of groups: P^T.M.P
+        """
+        ret_mat = numpy.zeros([self.ngroup, self.ngroup])
+        if len(self.groups) == 0: return ret_mat
+
+        if not self.ident: M = M[numpy.ix_(self.bas_inds, self.bas_inds)]
+        Mred = numpy.add.reduceat(numpy.add.reduceat(M, self.starts, axis=0, dtype=numpy.float64),
+                                  self.starts, axis=1)
+        ret_mat[numpy.ix_(self.groups, self.groups)] = Mred
+        return ret_mat
+
+#--------------------------------------------------------------------------#
+# Construction of specific partitions
+#--------------------------------------------------------------------------#
+
+def ret_atom_partition(bas, num_at):
+    """
+    One group per atom.
+    bas is a lib_mo.basis_fct_table.
+    """
+    at_inds = bas.at_ind - 1
+    order = numpy.argsort(at_inds, kind='stable')
+    counts = numpy.bincount(at_inds, minlength=num_at)
+    bounds = numpy.r_[0, numpy.cumsum(counts)]
+
+    group_list = [order[bounds[iat]:bounds[iat+1]] for iat in range(num_at)]
+    return partition(len(bas), group_list, ['%i'%(iat+1) for iat in range(num_at)])
+
+def ret_shell_partition(bas):
+    """
+    One group per shell.
+    """
+    shells = bas.shell
+    nshell = shells.max() + 1 if len(shells) > 0 else 0
+    group_list = [numpy.flatnonzero(shells == ish) for ish in range(nshell)]
+    labels = ['%i%s'%(bas.at_ind[group[0]], bas.shell_types[ish]) for ish, group in enumerate(group_list)]
+    return partition(len(bas), group_list, labels)
+
+def ret_l_partition(bas, num_at, l_list=['s', 'p', 'd', 'f', 'g']):
+    """
+    One group per atom and angular momentum channel (s/p/d/f per atom).
+    Only channels that are present in the basis set are considered.
+    """
+    group_list = []
+    labels = []
+    for iat in range(1, num_at+1):
+        for l in l_list:
+            group = numpy.flatnonzero(bas.ret_mask(iat, l))
+            if len(group) == 0: continue
+            group_list.append(group)
+            labels.append('%i%s'%(iat, l))
+    return partition(len(bas), group_list, labels)
+
+def ret_list_partition(bas, bas_lists):
+    """
+    User-defined groups.
+    Every entry of bas_lists describes one group as a list containing
+    atom indices (all functions of the atom) or (atom, l) tuples, e.g.
+        bas_lists = [[(1, 'd')], [(2, 'p'), (3, 'p')], [4, 5]]
+    l may be a single angular momentum label or a list of labels.
+    """
+    group_list = []
+    for bas_list in bas_lists:
+        mask = numpy.zeros(len(bas), bool)
+        for entry in bas_list:
+            if isinstance(entry, (tuple, list)):
+                mask |= bas.ret_mask(entry[0], entry[1])
+            else:
+                mask |= bas.ret_mask(entry)
+        group_list.append(numpy.flatnonzero(mask))
+
+    return partition(len(bas), group_list)
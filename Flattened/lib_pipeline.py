@@ -0,0 +1,231 @@
+"""
+Analysis pipeline with lazily evaluated stages.
+Every stage declares the stages it depends on. Only the stages that are needed for
+the requested output are evaluated, each of them at most once.
+"""
+
+import error_handler, lib_prof
+import time
+
+class stage:
+    """
+    One node of the pipeline.
+    """
+    def __init__(self, name, function, deps=[]):
+        self.name = name
+        self.function = function
+        self.deps = deps
+
+class pipeline:
+    """
+    Collection of stages, which are evaluated on demand.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.done = []
+        self.running = []
+        self.timings = [] # (name, CPU time, wall time)
+
+    def add_stage(self, name, function, deps=[]):
+        self.stages[name] = stage(name, function, deps)
+
+    def run(self, name):
+        """
+        Evaluate a stage after all its dependencies.
+        """
+        if name in self.done: return
+        if name in self.running:
+            raise error_handler.MsgError("Circular dependency in pipeline: %s"%(' -> '.join(self.running + [name])))
+
+        try:
+            st = self.stages[name]
+        except KeyError:
+            raise error_handler.ElseError(name, 'pipeline stage')
+
+        self.running.append(name)
+        for dep in st.deps:
+            self.run(dep)
+
+        (tc, tt) = (time.process_time(), time.time())
+        with lib_prof.prof.stage(name):
+            st.function()
+        self.timings.append((name, time.process_time() - tc, time.time() - tt))
+
+        self.running.pop()
+        self.done.append(name)
+
+    def run_all(self, targets):
+        """
+        Evaluate the requested stages in the given order.
+        """
+        for name in targets:
+            self.run(name)
+
+    def print_timings(self):
+        """
+        Print the timing report, the times do not include the dependencies.
+        """
+        print("\nTiming of the analysis stages:")
+        print("  %-12s %10s %10s"%('stage', 'CPU (s)', 'wall (s)'))
+        for name, tc, tt in self.timings:
+            print("  %-12s %10.2f %10.2f"%(name, tc, tt))
+
+#--------------------------------------------------------------------------#
+# Pipelines for the driver scripts
+#--------------------------------------------------------------------------#
+
+def ret_tden_pipeline(tdena, exca=None):
+    """
+    Pipeline for transition density matrix analysis.
+    tdena is a lib_tden.tden_ana instance, exca a lib_exciton.exciton_analysis instance.
+    Return the pipeline and the list of targets requested in the input options.
+    """
+    ioptions = tdena.ioptions
+    prop_list = ioptions.get('prop_list')
+    if ioptions['stream']: return ret_tden_stream_pipeline(tdena, exca)
+    pipe = pipeline()
+
+    def read_cache():
+        if ioptions['use_cache']: tdena.read_cache()
+
+    def read_mos():
+        if 'mo_file' in ioptions and tdena.ret_need_dens(): tdena.read_mos(comp_inv=False)
+
+    def read_dens():
+        if tdena.ret_need_dens():
+            tdena.read_dens()
+            tdena.merge_cache()
+
+    def inverse():
+        if getattr(tdena, 'mos', None) is not None and tdena.mos.inv_mo_mat is None:
+            tdena.mos.compute_inverse()
+
+    def OmFrag():
+        tdena.compute_all_OmFrag()
+        if ioptions['print_OmFrag']: tdena.fprint_OmFrag()
+
+    def exciton():
+        if 'exciton' in tdena.cache_valid: return
+        exca.get_distance_matrix(tdena.struc)
+        tdena.analyze_excitons(exca)
+
+    pipe.add_stage('cache', read_cache)
+    pipe.add_stage('mos', read_mos, ['cache'])
+    pipe.add_stage('dens', read_dens, ['mos'])
+    pipe.add_stage('inverse', inverse, ['dens'])
+    pipe.add_stage('OmAt', tdena.compute_all_OmAt, ['dens', 'inverse'])
+    pipe.add_stage('OmFrag', OmFrag, ['OmAt'])
+    pipe.add_stage('OmBasFrag', tdena.fprint_OmBasFrag, ['OmAt'])
+    pipe.add_stage('NTO', tdena.compute_all_NTO, ['dens'])
+    pipe.add_stage('exciton', exciton, ['OmAt'])
+    pipe.add_stage('cache_out', tdena.write_cache, ['dens'])
+    pipe.add_stage('precision', tdena.check_precision, ['OmAt'])
+
+    targets = []
+    summ_deps = ['dens']
+    if 'at_lists' in ioptions:
+        targets.append('OmFrag')
+        summ_deps.append('OmFrag')
+    if 'bas_lists' in ioptions and ioptions['print_OmFrag']:
+        targets.append('OmBasFrag')
+    if ioptions['comp_ntos']:
+        targets.append('NTO')
+        summ_deps.append('NTO')
+    if 'RMSeh' in prop_list or 'MAeh' in prop_list or 'Eb' in prop_list:
+        targets.append('exciton')
+        summ_deps.append('exciton')
+    if ioptions['use_cache']:
+        targets.append('cache_out')
+    if ioptions['dens_dtype'] != 'float64':
+        targets.append('precision')
+
+    pipe.add_stage('summary', tdena.print_summary, summ_deps)
+    targets.append('summary')
+
+    return pipe, targets
+
+def ret_tden_stream_pipeline(tdena, exca=None):
+    """
+    Pipeline for transition density matrix analysis in streaming mode.
+    All per-state analyses are done in the 'stream' stage while the states are read.
+    """
+    ioptions = tdena.ioptions
+    prop_list = ioptions.get('prop_list')
+    pipe = pipeline()
+
+    if not ('RMSeh' in prop_list or 'MAeh' in prop_list or 'Eb' in prop_list): exca = None
+    if ioptions['use_cache']:
+        print(" WARNING: previous results are not read from the cache in streaming mode")
+
+    def read_mos():
+        if 'mo_file' in ioptions: tdena.read_mos(comp_inv=False)
+
+    pipe.add_stage('mos', read_mos)
+    pipe.add_stage('stream', lambda: tdena.analyze_stream(exca), ['mos'])
+    pipe.add_stage('OmFrag', tdena.fprint_OmFrag, ['stream'])
+    pipe.add_stage('OmBasFrag', tdena.fprint_OmBasFrag, ['stream'])
+    pipe.add_stage('cache_out', tdena.write_cache, ['stream'])
+
+    targets = ['stream']
+    if 'at_lists' in ioptions and ioptions['print_OmFrag']:
+        targets.append('OmFrag')
+    if 'bas_lists' in ioptions and ioptions['print_OmFrag']:
+        targets.append('OmBasFrag')
+    if ioptions['use_cache']:
+        targets.append('cache_out')
+
+    pipe.add_stage('summary', tdena.print_summary, ['stream'])
+    targets.append('summary')
+
+    return pipe, targets
+
+def ret_sden_pipeline(sdena):
+    """
+    Pipeline for state density matrix analysis.
+    sdena is a lib_sden.sden_ana instance.
+    """
+    ioptions = sdena.ioptions
+    pipe = pipeline()
+
+    def read_mos():
+        if 'mo_file' in ioptions: sdena.read_mos(comp_inv=False)
+
+    if ioptions['stream']:
+        # all analyses and the print-out are done state by state
+        pipe.add_stage('mos', read_mos)
+        pipe.add_stage('stream', sdena.analyze_stream, ['mos'])
+        pipe.add_stage('summary', sdena.print_summary, ['stream'])
+        return pipe, ['stream', 'summary']
+
+    def inverse():
+        if getattr(sdena, 'mos', None) is not None and sdena.mos.inv_mo_mat is None:
+            sdena.mos.compute_inverse()
+
+    pipe.add_stage('mos', read_mos)
+    pipe.add_stage('dens', sdena.read_dens, ['mos'])
+    pipe.add_stage('inverse', inverse, ['dens'])
+    pipe.add_stage('AD', sdena.compute_all_AD, ['dens'])
+    pipe.add_stage('BO', sdena.compute_all_BO, ['dens', 'inverse'])
+    pipe.add_stage('pop', sdena.print_all_pop_table, ['dens', 'inverse'] + (['AD'] if ioptions['AD_ana'] else []))
+    pipe.add_stage('BO_print', sdena.print_all_BO, ['BO'])
+    pipe.add_stage('precision', sdena.check_precision, ['dens', 'inverse'])
+
+    targets = []
+    summ_deps = ['dens']
+    if ioptions['AD_ana']:
+        targets.append('AD')
+        summ_deps.append('AD')
+    if ioptions['BO_ana']:
+        targets.append('BO')
+        summ_deps.append('BO')
+    if ioptions['pop_ana']:
+        targets.append('pop')
+    if ioptions['BO_ana']:
+        targets.append('BO_print')
+    if ioptions['dens_dtype'] != 'float64':
+        targets.append('precision')
+
+    pipe.add_stage('summary', sdena.print_summary, summ_deps)
+    targets.append('summary')
+
+    return pipe, targets
@@ -0,0 +1,157 @@
+"""
+Profiling of the analysis stages.
+Wall time, CPU time, peak memory (RSS) and the size of the arrays created are
+recorded per stage and per state, and can be written to a JSON file.
+The profiler is switched off by default, in this case the overhead is negligible.
+
+Usage:
+    with lib_prof.prof.stage('name', state):
+        ...
+
+    @lib_prof.profile('name')
+    def function(self, state, ...):
+        ...
+"""
+
+import numpy
+import time, json, functools, contextlib, collections.abc
+
+def ret_maxrss():
+    """
+    Return the peak resident set size of the process in kB (None if not available).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def ret_nbytes(obj):
+    """
+    Return the total size of the numpy arrays contained in obj.
+    """
+    if isinstance(obj, numpy.ndarray):
+        return obj.nbytes
+    elif isinstance(obj, (tuple, list)):
+        return sum(ret_nbytes(el) for el in obj)
+    elif hasattr(obj, 'data') and hasattr(obj, 'indices') and hasattr(obj, 'indptr'):
+        # scipy.sparse CSR matrix
+        return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+    else:
+        return 0
+
+class profiler:
+    """
+    Collection of the profiling records.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self.stack = []
+
+    def enable(self):
+        self.enabled = True
+        self.t0 = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name, state=None):
+        """
+        Context manager for profiling one stage.
+        If state is given, the sizes of all new arrays in the state dictionary are recorded.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        rec = {'stage': name,
+               'parent': self.stack[-1]['stage'] if len(self.stack) > 0 else None,
+               'state': state['name'] if isinstance(state, collections.abc.Mapping) and 'name' in state else None,
+               'nbytes': 0}
+        old_keys = set(state.keys()) if isinstance(state, collections.abc.Mapping) else set()
+
+        self.stack.append(rec)
+        (tc, tt) = (time.process_time(), time.time())
+        try:
+            yield rec
+        finally:
+            rec['cpu'] = time.process_time() - tc
+            rec['wall'] = time.time() - tt
+            rec['start'] = tt - self.t0
+            rec['maxrss_kB'] = ret_maxrss()
+            if isinstance(state, collections.abc.Mapping):
+                rec['nbytes'] += sum(ret_nbytes(state[key]) for key in state if not key in old_keys)
+
+            self.stack.pop()
+            self.records.append(rec)
+
+    def profile(self, name=None):
+        """
+        Decorator for profiling a function or method.
+        The first dictionary among the arguments with a 'name' entry is treated as the state.
+        Without a state, the size of the arrays returned and of the arrays newly assigned
+        to attributes of the instance (for methods) is recorded.
+        """
+        def decorator(function):
+            sname = function.__qualname__ if name is None else name
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+
+                state = kwargs.get('state')
+                if state is None:
+                    for arg in args:
+                        if isinstance(arg, collections.abc.Mapping) and 'name' in arg:
+                            state = arg
+                            break
+
+                inst = args[0] if len(args) > 0 and hasattr(args[0], '__dict__') else None
+                if state is None and inst is not None:
+                    old_ids = dict((key, id(val)) for key, val in vars(inst).items())
+
+                with self.stage(sname, state) as rec:
+                    ret = function(*args, **kwargs)
+                    if state is None:
+                        rec['nbytes'] += ret_nbytes(ret)
+                        if inst is not None:
+                            rec['nbytes'] += sum(ret_nbytes(val) for key, val in vars(inst).items()
+                                                 if old_ids.get(key) != id(val))
+                return ret
+
+            return wrapper
+        return decorator
+
+    def ret_summary(self):
+        """
+        Return the total times and array sizes per stage.
+        """
+        summ = {}
+        for rec in self.records:
+            if not rec['stage'] in summ:
+                summ[rec['stage']] = {'calls': 0, 'cpu': 0., 'wall': 0., 'nbytes': 0}
+            entry = summ[rec['stage']]
+            entry['calls'] += 1
+            entry['cpu'] += rec['cpu']
+            entry['wall'] += rec['wall']
+            entry['nbytes'] += rec['nbytes']
+
+        return summ
+
+    def write_json(self, fname):
+        """
+        Write the report to a JSON file.
+        """
+        report = {'maxrss_kB': ret_maxrss(),
+                  'summary': self.ret_summary(),
+                  'records': self.records}
+
+        with open(fname, 'w') as f:
+            json.dump(report, f, indent=1)
+
+        print("Profiling report written to %s"%fname)
+
+# global instance used by all modules
+prof = profiler()
+profile = prof.profile
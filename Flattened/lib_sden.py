@@ -2,7 +2,7 @@
 Analysis routines for state density matrices.
 """
 
-import dens_ana_base, lib_mo, error_handler, pop_ana
+import dens_ana_base, lib_mo, lib_prof, error_handler, pop_ana
 import numpy
 
 numpy.set_printoptions(precision=6, suppress=True)
@@ -96,6 +96,7 @@ class sden_ana(dens_ana_base.dens_ana_base):
 # Operations
 #--------------------------------------------------------------------------#
 
+    @lib_prof.profile()
     def ret_general_pop(self, state, ana_type='mullpop', dens_type=''):
         """
         Return the result of a general population analysis.        
@@ -134,21 +135,28 @@ class sden_ana(dens_ana_base.dens_ana_base):
             jmolNDO.pre(ofile=self.ioptions['mo_file'])
         
         for state in self.state_list[1:]:
-            print("A/D analysis for %s"%state['name'])
-            (ad, W) = self.ret_NDO(state, self.state_list[0])
-            
-            if jmol_orbs:
-                self.export_NDOs_jmol(state, jmolNDO, ad, W)
-            
-            if self.ioptions['molden_orbitals']:
-                self.export_NDOs_molden(state, ad, W)
-            
-            if self.ioptions.get('pop_ana'):    
-                self.set_AD(state, ad, W)
+            self.AD_state(state, self.state_list[0], jmolNDO if jmol_orbs else None)
             
         if jmol_orbs:
             jmolNDO.post()
         
+    def AD_state(self, state, ref_state, jmolNDO=None):
+        """
+        Attachment/detachment analysis for one state.
+        """
+        print("A/D analysis for %s"%state['name'])
+        (ad, W) = self.ret_NDO(state, ref_state)
+        
+        if jmolNDO is not None:
+            self.export_NDOs_jmol(state, jmolNDO, ad, W)
+        
+        if self.ioptions['molden_orbitals']:
+            self.export_NDOs_molden(state, ad, W)
+        
+        if self.ioptions.get('pop_ana'):    
+            self.set_AD(state, ad, W)
+        
+    @lib_prof.profile()
     def ret_NDO(self, state, ref_state):
         dD = state['sden'] - ref_state['sden']
         
@@ -211,6 +219,63 @@ class sden_ana(dens_ana_base.dens_ana_base):
                           numpy.dot(numpy.diag(ad*neg),
                                     numpy.transpose(W)))
 
+#--- Streaming mode
+
+    def analyze_stream(self):
+        """
+        Read the states one at a time, perform all requested analyses and the print-out,
+            and release the densities before the next state is read.
+        The density of the first state is kept as the reference for the A/D analysis.
+        """
+        AD_ana = self.ioptions['AD_ana']
+        jmolNDO = None
+        ref_state = None
+        
+        dens_types = ['state']
+        if self.ioptions['unpaired_ana']: dens_types += ['nu', 'nunl']
+        if self.ioptions['AD_ana']:       dens_types += ['det', 'att']
+        
+        for state in self.iter_dens():
+            print("\n" + state['name'])
+            if getattr(self, 'mos', None) is not None and self.mos.inv_mo_mat is None:
+                self.mos.compute_inverse()
+            
+            if AD_ana and 'sden' in state:
+                if ref_state is None:
+                    ref_state = state
+                else:
+                    if jmolNDO is None and self.ioptions.get('jmol_orbitals'):
+                        jmolNDO = lib_mo.jmol_MOs("ndo")
+                        jmolNDO.pre(ofile=self.ioptions['mo_file'])
+                    self.AD_state(state, ref_state, jmolNDO)
+                
+            if self.ioptions['BO_ana']:
+                self.ret_BO(state)
+                
+            if self.ioptions['pop_ana']:
+                self.print_pop_table(state, dens_types=dens_types)
+                
+            if self.ioptions['BO_ana']:
+                self.print_valence_table(state)
+                self.print_BO(state)
+                
+            if 'sden' in state: self.check_precision()
+            self.release_dens(state, keep=['sden'] if state is ref_state else [])
+        
+        if ref_state is not None: self.release_dens(ref_state)
+        
+        if jmolNDO is not None:
+            jmolNDO.post()
+        
+    def ret_precision_devs(self, state, state64):
+        """
+        Compare the Mulliken populations of the state against double precision.
+        """
+        mp = self.ret_general_pop(state)
+        if mp is None: return []
+        
+        return [('mullpop', abs(mp - self.ret_general_pop(state64)).max())]
+        
 #--- Bond orders
     def compute_all_BO(self):
         """
@@ -219,6 +284,7 @@ class sden_ana(dens_ana_base.dens_ana_base):
         for state in self.state_list:
             BO = self.ret_BO(state)            
             
+    @lib_prof.profile()
     def ret_BO(self, state):
         """
         Return the bond order and compute some descriptors related to the bond order.
@@ -237,25 +303,13 @@ class sden_ana(dens_ana_base.dens_ana_base):
         DS   = self.mos.MdotC(temp, trnsp=False, inv=True) # DAO.S = C.D.C^(-1)
         
         # add up the contributions for the different atoms        
-        state['BO'] = numpy.zeros([self.mos.num_at, self.mos.num_at])
-        
-        for i in range(self.num_bas):
-            iat = self.mos.basis_fcts[i].at_ind - 1 
-            for j in range(self.num_bas):
-                jat = self.mos.basis_fcts[j].at_ind - 1
-                state['BO'][iat, jat] += DS[i, j] * DS[j, i]
+        state['BO'] = self.mos.basis_fcts.ret_at_mat(DS * DS.transpose(), self.mos.num_at)
         
         QA = pop_ana.mullpop_ana().ret_pop(D, self.mos, DS)
         
-        state['V_A'] = numpy.zeros([self.mos.num_at])
-        state['F_A'] = numpy.zeros([self.mos.num_at])
-        state['tBO'] = numpy.zeros([self.mos.num_at]) # direct valence
-        for iat in range(self.mos.num_at):
-            state['V_A'][iat] = 2 * QA[iat] - state['BO'][iat, iat]
-            state['F_A'][iat] = state['V_A'][iat]
-            for jat in range(self.mos.num_at):
-                if jat!=iat:
-                    state['F_A'][iat] -= state['BO'][iat, jat]                   
-                    state['tBO'][iat] += state['BO'][iat, jat]                   
+        BOdiag = state['BO'].diagonal()
+        state['V_A'] = 2 * QA - BOdiag
+        state['tBO'] = state['BO'].sum(axis=1) - BOdiag # direct valence
+        state['F_A'] = state['V_A'] - state['tBO']
                 
         return state['BO']
\ No newline at end of file
@@ -0,0 +1,350 @@
+"""
+Container for the data of all states.
+The scalar properties of all states are stored column-wise (struct of arrays),
+the densities and other arrays are kept in separate lists per key.
+The individual states are accessed through light-weight records that behave like dictionaries.
+"""
+
+import numpy
+import os, shutil, atexit, tempfile, collections, collections.abc
+
+scalar_types = (bool, int, float, str, numpy.bool_, numpy.integer, numpy.floating)
+
+# entries that are kept in the density store
+dens_keys = ['tden', 'sden', 'att_den', 'det_den', 'nu_den', 'nunl_den']
+
+class dens_store:
+    """
+    Storage of the density matrices of all states with a memory budget.
+    If the budget is exceeded, the least recently used matrices are moved
+        to memory-mapped temporary files.
+    The matrices are referred to by integer handles.
+    """
+    def __init__(self, budget=None):
+        self.set_budget(budget)
+
+        self.entries = collections.OrderedDict() # most recently used at the end
+        self.nbytes = 0 # size of the matrices kept in memory
+        self.nhandle = 0
+        self.nspill = 0
+        self.tmpdir = None
+
+    def set_budget(self, budget):
+        """
+        Set the memory budget in MB (None: unlimited).
+        """
+        self.budget = None if budget is None else int(budget * 2**20)
+
+    def add(self, arr):
+        handle = self.nhandle
+        self.nhandle += 1
+
+        self.entries[handle] = arr
+        self.nbytes += arr.nbytes
+        self.check(keep=handle)
+
+        return handle
+
+    def get(self, handle):
+        self.entries.move_to_end(handle)
+        return self.entries[handle]
+
+    def remove(self, handle):
+        arr = self.entries.pop(handle)
+        if isinstance(arr, numpy.memmap):
+            fname = arr.filename
+            del arr
+            os.remove(fname)
+        else:
+            self.nbytes -= arr.nbytes
+
+    def check(self, keep=None):
+        """
+        Move matrices to files until the budget is met.
+        The matrix keep (the one that was just added) is not moved.
+        """
+        if self.budget is None: return
+
+        for handle in list(self.entries.keys()):
+            if self.nbytes <= self.budget: break
+            arr = self.entries[handle]
+            if handle == keep or isinstance(arr, numpy.memmap): continue
+
+            self.entries[handle] = self.spill(handle, arr)
+            self.nbytes -= arr.nbytes
+
+    def spill(self, handle, arr):
+        """
+        Write arr into a memory-mapped file and return the mapped array.
+        """
+        if self.tmpdir is None:
+            self.tmpdir = tempfile.mkdtemp(prefix='theo_dens_')
+            atexit.register(shutil.rmtree, self.tmpdir, True)
+            print(" Memory budget for the densities exceeded, using memory-mapped files in %s"%self.tmpdir)
+
+        mm = numpy.lib.format.open_memmap(os.path.join(self.tmpdir, 'dens_%i.npy'%handle),
+                                          mode='w+', dtype=arr.dtype, shape=arr.shape)
+        mm[...] = arr
+        mm.flush()
+        self.nspill += 1
+
+        return mm
+
+# global store shared by all state tables
+store = dens_store()
+
+def ret_kind(val):
+    """
+    Return the numpy kind of a scalar value ('b', 'i', 'f' or 'O').
+    """
+    if isinstance(val, (bool, numpy.bool_)):
+        return 'b'
+    elif isinstance(val, (int, numpy.integer)):
+        return 'i'
+    elif isinstance(val, (float, numpy.floating)):
+        return 'f'
+    else:
+        return 'O'
+
+class state_rec(collections.abc.MutableMapping):
+    """
+    View of one state in a state_table with a dictionary interface.
+    """
+    __slots__ = ('table', 'ind')
+
+    def __init__(self, table, ind):
+        self.table = table
+        self.ind = ind
+
+    def __getitem__(self, key):
+        return self.table.get_val(self.ind, key)
+
+    def __setitem__(self, key, val):
+        self.table.set_val(self.ind, key, val)
+
+    def __delitem__(self, key):
+        self.table.del_val(self.ind, key)
+
+    def __contains__(self, key):
+        return self.table.has_val(self.ind, key)
+
+    def __iter__(self):
+        return iter(self.table.ret_keys(self.ind))
+
+    def __len__(self):
+        return len(self.table.ret_keys(self.ind))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class state_table:
+    """
+    Table containing the data of all states.
+    It can be used like the list of dictionaries that was used before:
+        state_list.append({})
+        state = state_list[-1]
+        state['exc_en'] = 3.5
+    """
+    def __init__(self, cap=16):
+        self.nstate = 0
+        self.cap = cap
+
+        self.cols  = {} # scalar columns
+        self.masks = {} # which states have a value in the column
+        self.dens  = {} # handles of the densities in the store, one list per key
+        self.arrs  = {} # other numpy arrays (OmAt, ...), one list per key
+        self.extra = [] # other objects, dictionary per state (or None)
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            # the store may be gone at interpreter shutdown
+            pass
+
+    def release(self):
+        """
+        Remove the densities of all states from the store.
+        """
+        for hlist in self.dens.values():
+            for ind, handle in enumerate(hlist):
+                if handle is not None:
+                    store.remove(handle)
+                    hlist[ind] = None
+
+    def __len__(self):
+        return self.nstate
+
+    def __getitem__(self, ind):
+        if isinstance(ind, slice):
+            return [state_rec(self, i) for i in range(*ind.indices(self.nstate))]
+
+        if ind < 0: ind += self.nstate
+        if not 0 <= ind < self.nstate:
+            raise IndexError('state index out of range')
+        return state_rec(self, ind)
+
+    def __iter__(self):
+        for ind in range(self.nstate):
+            yield state_rec(self, ind)
+
+    def append(self, state={}):
+        """
+        Add a state, its entries are copied from the dictionary state.
+        """
+        if self.nstate == self.cap:
+            self.grow(2 * self.cap)
+
+        ind = self.nstate
+        self.nstate += 1
+        self.extra.append(None)
+        for hlist in self.dens.values():
+            hlist.append(None)
+        for arrl in self.arrs.values():
+            arrl.append(None)
+
+        for key, val in state.items():
+            self.set_val(ind, key, val)
+
+        return state_rec(self, ind)
+
+    def grow(self, cap):
+        for key in self.cols:
+            col = numpy.zeros(cap, dtype=self.cols[key].dtype)
+            col[:self.cap] = self.cols[key]
+            self.cols[key] = col
+
+            mask = numpy.zeros(cap, dtype=bool)
+            mask[:self.cap] = self.masks[key]
+            self.masks[key] = mask
+
+        self.cap = cap
+
+#--------------------------------------------------------------------------#
+# Access to individual entries
+#--------------------------------------------------------------------------#
+
+    def get_val(self, ind, key):
+        if key in self.cols and self.masks[key][ind]:
+            col = self.cols[key]
+            return col[ind] if col.dtype.kind == 'O' else col[ind].item()
+        elif key in self.dens and self.dens[key][ind] is not None:
+            return store.get(self.dens[key][ind])
+        elif key in self.arrs and self.arrs[key][ind] is not None:
+            return self.arrs[key][ind]
+        elif self.extra[ind] is not None and key in self.extra[ind]:
+            return self.extra[ind][key]
+        else:
+            raise KeyError(key)
+
+    def set_val(self, ind, key, val):
+        if self.has_val(ind, key):
+            # in-place operations (state[key] += ...) on arrays store the same object again
+            if isinstance(val, numpy.ndarray) and self.get_val(ind, key) is val: return
+
+            # remove the old entry, which may be of a different type
+            self.del_val(ind, key)
+
+        if isinstance(val, scalar_types):
+            self.set_scalar(ind, key, val)
+        elif isinstance(val, numpy.ndarray) and key in dens_keys:
+            if not key in self.dens:
+                self.dens[key] = [None for i in range(self.nstate)]
+            self.dens[key][ind] = store.add(val)
+        elif isinstance(val, numpy.ndarray):
+            if not key in self.arrs:
+                self.arrs[key] = [None for i in range(self.nstate)]
+            self.arrs[key][ind] = val
+        else:
+            if self.extra[ind] is None: self.extra[ind] = {}
+            self.extra[ind][key] = val
+
+    def set_scalar(self, ind, key, val):
+        kind = ret_kind(val)
+        if not key in self.cols:
+            self.cols[key] = numpy.zeros(self.cap, dtype={'b':bool, 'i':int, 'f':float, 'O':object}[kind])
+            self.masks[key] = numpy.zeros(self.cap, dtype=bool)
+        elif self.cols[key].dtype.kind != kind and self.cols[key].dtype.kind != 'O':
+            # mixed types are stored as objects
+            self.cols[key] = self.cols[key].astype(object)
+
+        self.cols[key][ind] = val
+        self.masks[key][ind] = True
+
+    def has_val(self, ind, key):
+        if key in self.cols and self.masks[key][ind]:
+            return True
+        elif key in self.dens and self.dens[key][ind] is not None:
+            return True
+        elif key in self.arrs and self.arrs[key][ind] is not None:
+            return True
+        else:
+            return self.extra[ind] is not None and key in self.extra[ind]
+
+    def del_val(self, ind, key):
+        if key in self.cols and self.masks[key][ind]:
+            self.masks[key][ind] = False
+        elif key in self.dens and self.dens[key][ind] is not None:
+            store.remove(self.dens[key][ind])
+            self.dens[key][ind] = None
+        elif key in self.arrs and self.arrs[key][ind] is not None:
+            self.arrs[key][ind] = None
+        elif self.extra[ind] is not None and key in self.extra[ind]:
+            del self.extra[ind][key]
+        else:
+            raise KeyError(key)
+
+    def ret_keys(self, ind):
+        keys = [key for key in self.cols if self.masks[key][ind]]
+        keys += [key for key in self.dens if self.dens[key][ind] is not None]
+        keys += [key for key in self.arrs if self.arrs[key][ind] is not None]
+        if self.extra[ind] is not None:
+            keys += list(self.extra[ind].keys())
+        return keys
+
+#--------------------------------------------------------------------------#
+# Column-wise access
+#--------------------------------------------------------------------------#
+
+    def ret_scalar_keys(self):
+        """
+        Return the keys of all scalar columns that are set for at least one state.
+        """
+        return [key for key in self.cols if self.masks[key][:self.nstate].any()]
+
+    def ret_col(self, key):
+        """
+        Return the values of a scalar property for all states and the mask
+            of the states for which the value is set.
+        """
+        if not key in self.cols:
+            raise KeyError(key)
+
+        return self.cols[key][:self.nstate], self.masks[key][:self.nstate]
+
+    def ret_arrs(self, key):
+        """
+        Return the entries of a non-scalar property (e.g. OmAt) for all states
+            as a list, None for the states without the entry.
+        """
+        if key in self.dens:
+            return [None if handle is None else store.get(handle) for handle in self.dens[key][:self.nstate]]
+        elif key in self.arrs:
+            return self.arrs[key][:self.nstate]
+        else:
+            return [None if extra is None else extra.get(key) for extra in self.extra[:self.nstate]]
+
+    def ret_stack(self, key):
+        """
+        Return the arrays of all states (e.g. the densities) stacked into one array.
+        All states have to contain the entry and the shapes have to agree.
+        """
+        if key in self.dens:
+            arrs = [None if handle is None else store.get(handle) for handle in self.dens[key]]
+        else:
+            arrs = self.arrs.get(key, [None])
+
+        if any(arr is None for arr in arrs):
+            raise KeyError(key)
+
+        return numpy.array(arrs)
@@ -3,7 +3,7 @@ Analysis routines for transition density matrices.
 """
 
 
-import dens_ana_base, Om_descriptors, lib_mo, error_handler
+import dens_ana_base, Om_descriptors, lib_mo, lib_partition, lib_cache, lib_prof, error_handler
 import numpy
 
 numpy.set_printoptions(precision=6, suppress=True)
@@ -13,6 +13,11 @@ class tden_ana(dens_ana_base.dens_ana_base):
     Analysis of transition density matrices.
     """
     # TODO: more efficient treatment for sparse matrices.
+    def __init__(self, *args, **kwargs):
+        dens_ana_base.dens_ana_base.__init__(self, *args, **kwargs)
+        
+        self.bas_part = None # partition of the basis functions according to bas_lists
+        self.frag_parts = {} # partitions of the atoms according to at_lists
     
 #--------------------------------------------------------------------------#        
 # Print out
@@ -84,6 +89,28 @@ class tden_ana(dens_ana_base.dens_ana_base):
             
         omf.close()
         
+    def fprint_OmBasFrag(self, fname="OmBasFrag.txt"):
+        """
+        Print a file containing the Omega matrix with respect to the basis function groups in bas_lists.
+        The format is the same as for OmFrag.txt.
+        """
+        part = self.ret_bas_partition()
+        print("\nOmega matrices with respect to basis function groups written to %s"%fname)
+        print("  Groups: " + " ".join(part.labels))
+        
+        omf = open(fname, 'w')
+        
+        omf.write("%i\n"%part.ngroup)
+        for state in self.state_list:
+            if not 'OmBasFrag' in state:
+                continue
+            omf.write("%10s %8.5f"%(state['name'], state['Om']))
+            for el in state['OmBasFrag'].flatten():
+                omf.write(" %8.5f"%el)
+            omf.write("\n")
+            
+        omf.close()
+        
 #---
 
     def print_all_Om_descriptors(self, lvprt=2, desc_list=[]):
@@ -147,6 +174,7 @@ class tden_ana(dens_ana_base.dens_ana_base):
         for state in self.state_list:
             Om, OmAt = self.ret_Om_OmAt(state)
             
+    @lib_prof.profile()
     def ret_Om_OmAt(self, state):
         """
         Construction of the Omega matrix with respect to atoms. 
@@ -182,10 +210,6 @@ class tden_ana(dens_ana_base.dens_ana_base):
             # S.DAO.S = C^(-1,T).D.C^(-1)
             SDS = self.mos.MdotC(temp, trnsp=False, inv=True)
 
-        # add up the contributions for the different atoms        
-        state['Om'] = 0.
-        state['OmAt'] = numpy.zeros([self.mos.num_at, self.mos.num_at])
-        
         if   formula == 0:
             OmBas = DS * SD
         elif formula == 1:
@@ -193,15 +217,37 @@ class tden_ana(dens_ana_base.dens_ana_base):
         else:
             raise error_handler.MsgError("Om_formula=%i for CT numbers not implemented!"%formula)
         
-        for i in range(self.num_bas):
-            iat = self.mos.basis_fcts[i].at_ind - 1 
-            for j in range(self.num_bas):
-                jat = self.mos.basis_fcts[j].at_ind - 1
-                state['Om'] += OmBas[i, j]
-                state['OmAt'][iat, jat] += OmBas[i, j]
+        # add up the contributions for the different atoms        
+        state['OmAt'] = self.mos.basis_fcts.ret_at_mat(OmBas, self.mos.num_at)
+        state['Om'] = state['OmAt'].sum()
+        
+        # contributions of the basis function groups, only one more projection is needed
+        if 'bas_lists' in self.ioptions:
+            state['OmBasFrag'] = self.ret_bas_partition().reduce_mat(OmBas)
                 
         return state['Om'], state['OmAt']
         
+    def ret_bas_partition(self):
+        """
+        Return the partition of the basis functions specified in bas_lists.
+        bas_lists is either 'shells', 'l' (angular momentum channels on every atom),
+        or a list of user-defined groups (see lib_partition.ret_list_partition).
+        """
+        if self.bas_part is None:
+            bas_lists = self.ioptions['bas_lists']
+            bas = self.mos.basis_fcts
+            
+            if bas_lists == 'shells':
+                self.bas_part = lib_partition.ret_shell_partition(bas)
+            elif bas_lists == 'l':
+                self.bas_part = lib_partition.ret_l_partition(bas, self.mos.num_at)
+            elif isinstance(bas_lists, str):
+                raise error_handler.ElseError(bas_lists, 'bas_lists')
+            else:
+                self.bas_part = lib_partition.ret_list_partition(bas, bas_lists)
+                
+        return self.bas_part
+        
 #---    
 
     def compute_all_OmFrag(self):
@@ -215,6 +261,7 @@ class tden_ana(dens_ana_base.dens_ana_base):
         for state in self.state_list:
             Om, OmFrag = self.ret_Om_OmFrag(state, self.ioptions.get('at_lists'))
             
+    @lib_prof.profile()
     def ret_Om_OmFrag(self, state, at_lists=None):
         if at_lists == None:
             try:
@@ -227,15 +274,22 @@ class tden_ana(dens_ana_base.dens_ana_base):
         if Om == None:
             return None, None
         
-        state['OmFrag'] = numpy.zeros([len(at_lists), len(at_lists)])
-        
-        for A, Aatoms in enumerate(at_lists):
-            for B, Batoms in enumerate(at_lists):
-                for Aatom in Aatoms:
-                    for Batom in Batoms:
-                        state['OmFrag'][A, B] += state['OmAt'][Aatom-1, Batom-1]
+        state['OmFrag'] = self.ret_frag_partition(at_lists, len(OmAt)).reduce_mat(OmAt)
                         
         return state['Om'], state['OmFrag']
+        
+    def ret_frag_partition(self, at_lists, num_at):
+        """
+        Return the partition of the atoms into the fragments given in at_lists.
+        The partitions are stored in self.frag_parts, which may be shared between
+            several instances (e.g. for the time steps of a trajectory).
+        """
+        key = (repr(at_lists), num_at)
+        if not key in self.frag_parts:
+            group_list = [numpy.array(at_list, dtype=int) - 1 for at_list in at_lists]
+            self.frag_parts[key] = lib_partition.partition(num_at, group_list)
+            
+        return self.frag_parts[key]
 #---
 
     def compute_all_NTO(self):
@@ -248,24 +302,33 @@ class tden_ana(dens_ana_base.dens_ana_base):
             jmolNTO.pre(ofile=self.ioptions.get('mo_file', strict=False))
         
         for state in self.state_list:
-            (U, lam, Vt) = self.ret_NTO(state)
-            if jmol_orbs:
-                self.export_NTOs_jmol(state, jmolNTO, U, lam, Vt)
-                
-            if self.ioptions['molden_orbitals']:
-                self.export_NTOs_molden(state, U, lam, Vt)
+            self.compute_NTO(state, jmolNTO if jmol_orbs else None)
             
         if jmol_orbs:
             jmolNTO.post()
             
+    def compute_NTO(self, state, jmolNTO=None):
+        """
+        Compute the NTOs of one state and export them.
+        """
+        (U, lam, Vt) = self.ret_NTO(state)
+        if jmolNTO is not None:
+            self.export_NTOs_jmol(state, jmolNTO, U, lam, Vt)
+            
+        if self.ioptions['molden_orbitals']:
+            self.export_NTOs_molden(state, U, lam, Vt)
+            
+    @lib_prof.profile()
     def ret_NTO(self, state):
         if not 'tden' in state: return None, None, None
         
         # sqrlam contains the squareroot of the singular values lambda as defined in JCP 141, 024106 (2014).
         (U, sqrlam, Vt) = numpy.linalg.svd(state['tden'])        
+        sqrlam = sqrlam.astype(numpy.float64)
         lam = sqrlam * sqrlam
         
         state['PRNTO'] = lam.sum() * lam.sum() / (lam*lam).sum()
+        state['NTOlam'] = lam
         
         return U, lam, Vt
         
@@ -296,6 +359,7 @@ class tden_ana(dens_ana_base.dens_ana_base):
             jmolF += ']\n'
             jmolNTO.add_mo(jmolF, "NTO%s_%iv"%(sname,i+1), l)
         
+    @lib_prof.profile()
     def export_NTOs_molden(self, state, U, lam, Vt, mincoeff=0.2, minlam=0.01):
         """
         Export the NTOs to a molden file.
@@ -308,9 +372,125 @@ class tden_ana(dens_ana_base.dens_ana_base):
 
     def analyze_excitons(self, exciton_ana):
         for state in self.state_list:
-            Om, OmAt = self.ret_Om_OmAt(state)
-            if Om == None: continue
+            self.analyze_exciton(state, exciton_ana)
+            
+    def analyze_exciton(self, state, exciton_ana):
+        if 'RMSeh' in state and 'MAeh' in state and 'Eb' in state: return
+        
+        Om, OmAt = self.ret_Om_OmAt(state)
+        if Om == None: return
+        
+        state['RMSeh'] = exciton_ana.ret_RMSeh(Om, OmAt)
+        state['MAeh']  = exciton_ana.ret_MAeh(Om, OmAt)
+        state['Eb']    = exciton_ana.ret_Eb(Om, OmAt, self.ioptions['Eb_diag'])
+        
+#--------------------------------------------------------------------------#        
+# Streaming mode
+#--------------------------------------------------------------------------#     
+
+    def analyze_stream(self, exciton_ana=None):
+        """
+        Read the states one at a time, perform all requested analyses,
+            and release the transition density before the next state is read.
+        exciton_ana: lib_exciton.exciton_analysis instance if the exciton descriptors are requested
+        """
+        at_lists = self.ioptions['at_lists'] if 'at_lists' in self.ioptions else None
+        comp_OmAt = at_lists is not None or 'bas_lists' in self.ioptions or exciton_ana is not None
+        
+        comp_ntos = self.ioptions['comp_ntos']
+        jmolNTO = None
+        
+        for state in self.iter_dens():
+            if 'tden' in state:
+                if comp_OmAt and self.mos.inv_mo_mat is None:
+                    self.mos.compute_inverse()
+                
+                if comp_ntos:
+                    if jmolNTO is None and self.ioptions['jmol_orbitals']:
+                        jmolNTO = lib_mo.jmol_MOs("nto")
+                        jmolNTO.pre(ofile=self.ioptions.get('mo_file', strict=False))
+                    self.compute_NTO(state, jmolNTO)
+            
+            if comp_OmAt:
+                self.ret_Om_OmAt(state)
+            if at_lists is not None:
+                self.ret_Om_OmFrag(state, at_lists)
+            if exciton_ana is not None:
+                if exciton_ana.distmat is None:
+                    exciton_ana.get_distance_matrix(self.struc)
+                self.analyze_exciton(state, exciton_ana)
+                
+            if 'tden' in state: self.check_precision()
+            self.release_dens(state)
+            
+        if jmolNTO is not None:
+            jmolNTO.post()
+            
+    def ret_precision_devs(self, state, state64):
+        """
+        Compare the Omega matrices (and the CT numbers) of the state against double precision.
+        """
+        devs = []
+        
+        Om, OmAt = self.ret_Om_OmAt(state)
+        if Om is None: return devs
+        Om64, OmAt64 = self.ret_Om_OmAt(state64)
+        devs.append(('Om', abs(Om - Om64)))
+        devs.append(('OmAt', abs(OmAt - OmAt64).max()))
+        
+        if 'at_lists' in self.ioptions:
+            at_lists = self.ioptions['at_lists']
+            OmFrag = self.ret_Om_OmFrag(state, at_lists)[1]
+            OmFrag64 = self.ret_Om_OmFrag(state64, at_lists)[1]
+            devs.append(('OmFrag', abs(OmFrag - OmFrag64).max()))
             
-            state['RMSeh'] = exciton_ana.ret_RMSeh(Om, OmAt)
-            state['MAeh']  = exciton_ana.ret_MAeh(Om, OmAt)
-            state['Eb']    = exciton_ana.ret_Eb(Om, OmAt, self.ioptions['Eb_diag'])
+        return devs
+
+#--------------------------------------------------------------------------#        
+# Cache of the results
+#--------------------------------------------------------------------------#     
+
+    def ret_cache_fps(self):
+        """
+        Fingerprints of the stages:
+            states: parsed information, depends only on the input files
+            OmAt: Omega matrices, depend additionally on Om_formula
+            NTO: NTO singular values
+            exciton: exciton descriptors, depend additionally on the coordinates and Eb_diag
+        """
+        fps = dens_ana_base.dens_ana_base.ret_cache_fps(self)
+        
+        fps['OmAt'] = lib_cache.ret_fingerprint(self.ioptions, ['Om_formula'], []) + fps['states']
+        fps['NTO'] = fps['states']
+        
+        coor_files = [self.ioptions['coor_file']] if 'coor_file' in self.ioptions else []
+        fps['exciton'] = lib_cache.ret_fingerprint(self.ioptions, ['coor_format', 'Eb_diag'], coor_files) + fps['OmAt']
+        
+        return fps
+        
+    def ret_cache_keys(self):
+        return {'Om': 'OmAt', 'OmAt': 'OmAt',
+                'PRNTO': 'NTO', 'NTOlam': 'NTO',
+                'RMSeh': 'exciton', 'MAeh': 'exciton', 'Eb': 'exciton'}
+        
+    def ret_need_dens(self):
+        """
+        Check if the densities have to be read, or if all required stages are available from the cache.
+        The OmFrag matrices and the descriptors are always recomputed.
+        NTO files of a previous run are not rewritten.
+        """
+        if not 'OmAt' in self.cache_valid: return True
+        if 'bas_lists' in self.ioptions: return True
+        if self.ioptions['comp_ntos'] and not 'NTO' in self.cache_valid: return True
+        
+        return False
+        
+    def merge_cache(self):
+        """
+        Take over the cached results for newly parsed densities.
+        The Omega matrix in the basis function representation is needed for bas_lists.
+        """
+        if 'bas_lists' in self.ioptions:
+            dens_ana_base.dens_ana_base.merge_cache(self, skip_stages=['OmAt', 'exciton'])
+        else:
+            dens_ana_base.dens_ana_base.merge_cache(self)
@@ -6,7 +6,7 @@ Script for plotting the Omega matrix.
 
 import theo_header, input_options, lib_file, error_handler
 import numpy
-import os
+import os, json, hashlib, multiprocessing
 
 try:
     import matplotlib
@@ -16,6 +16,9 @@ except:
     print("pylab/matplotlib not installed - plotting not possible")
     raise
 
+# options that influence the appearance of the individual plots
+plot_keys = ['plot_type', 'plot_dpi', 'cmap', 'fsize', 'output_format', 'sscale', 'vmax', 'axis', 'ticks', 'cbar']
+
 class OmFrag_options(input_options.write_options):
     """
     Set and store the options for plotting.
@@ -23,6 +26,7 @@ class OmFrag_options(input_options.write_options):
     def __init__(self, *args, **kwargs):
         self.state_list = []
         self.maxOm = 0.
+        self.cache_file = 'OmFrag_cache.json'
         
         input_options.write_options.__init__(self, *args, **kwargs)
 
@@ -48,12 +52,8 @@ class OmFrag_options(input_options.write_options):
             state = self.state_list[-1]
             state['name'] = words[0]
             state['Om'] = words[1]
-            state['OmFrag'] = numpy.zeros([numF, numF])
-            
-            for iel, el in enumerate(words[2:]):
-                iF = iel % numF
-                jF = iel / numF
-                state['OmFrag'][iF, jF] = el
+            state['OmFrag'] = numpy.array(words[2:], dtype=float).reshape([numF, numF]).transpose()
+            state['hash'] = hashlib.sha1(line.strip().encode()).hexdigest()
                 
             self.maxOm = max(self.maxOm, state['OmFrag'].max())
 
@@ -90,6 +90,29 @@ class OmFrag_options(input_options.write_options):
         self.read_yn('Plot colorbar for each individual plot?', 'cbar', False)
     
             
+        self.read_int('Number of processes for plotting', 'nproc', 1)
+        self.read_yn('Skip states whose plots are unchanged since the last run', 'use_cache', True)
+        
+    def ret_plot_opts(self):
+        popts = {}
+        for key in plot_keys:
+            popts[key] = self.opt_dict.get(key)
+        if not popts['sscale']: popts['vmax'] = None
+        
+        return popts
+    
+    def ret_state_hash(self, state, popts):
+        """
+        Hash of the OmFrag data of a state together with the plot options.
+        """
+        return hashlib.sha1((state['hash'] + json.dumps(popts, sort_keys=True)).encode()).hexdigest()
+    
+    def read_cache(self):
+        try:
+            return json.load(open(self.cache_file))
+        except (IOError, ValueError):
+            return {}
+    
     def plot(self):
         hfname = 'OmFrag.html'
         hfile = lib_file.htmlfile(hfname)
@@ -98,62 +121,39 @@ class OmFrag_options(input_options.write_options):
         
         htable = lib_file.htmltable(ncol=4)
         
-        matplotlib.rc('font', size=self['fsize'])
+        popts = self.ret_plot_opts()
+        use_cache = self.opt_dict.get('use_cache', False)
+        cache = self.read_cache() if use_cache else {}
+        new_cache = {}
         
+        jobs = []
         for state in self.state_list:
-            if self['plot_type'] == 1:
-                plot_arr = state['OmFrag']
-            elif self['plot_type'] == 2:
-                plot_arr = numpy.sqrt(state['OmFrag'])
-            else:
-                raise error_handler.ElseError(str(self['plot_type']), 'plot_type')
-            
-            if self['sscale']:
-                vmax = self['vmax']
-            else:
-                vmax = state['OmFrag'].max()
-            
-            pylab.figure(figsize=(2,2))
-            pylab.pcolor(plot_arr, cmap=pylab.get_cmap(name=self['cmap']), vmin=0., vmax=vmax)
+            pname = 'pcolor_%s.%s'%(state['name'], self['output_format'])
+            shash = self.ret_state_hash(state, popts)
+            new_cache[pname] = shash
             
-            if self['axis']:
-                pylab.axis('on')
-                if self['ticks']:
-                    pylab.xticks([x + 0.5 for x in range(len(plot_arr))], [x + 1 for x in range(len(plot_arr))])
-                    pylab.yticks([y + 0.5 for y in range(len(plot_arr))], [y + 1 for y in range(len(plot_arr))])
-                else:
-                    pylab.xticks([])
-                    pylab.yticks([])                    
+            if use_cache and cache.get(pname) == shash and os.path.exists(pname):
+                print("Skipping %s (unchanged)"%pname)
             else:
-                pylab.axis('off')
-            
-            if self['cbar']: pylab.colorbar()
-            
-            pname = 'pcolor_%s.%s'%(state['name'], self['output_format'])
-            print("Writing %s ..."%pname)
-            pylab.savefig(pname, dpi=self['plot_dpi'])
+                jobs.append((pname, state['OmFrag']))
             
             tel  = '<img src="%s", border="1" width="200">\n'%pname
             tel += '<br>%s'%state['name']
             htable.add_el(tel)
         
-        # create a plot with the e/h axes and optionally the scale
-        pylab.figure(figsize=(2,2))        
-        ax = pylab.axes()
-        ax.arrow(0.15, 0.15, 0.5, 0., head_width=0.05, head_length=0.1, fc='k', ec='k')
-        ax.text(0.20, 0.05, 'hole')
-        ax.arrow(0.15, 0.15, 0., 0.5, head_width=0.05, head_length=0.1, fc='k', ec='k')    
-        ax.text(0.02, 0.20, 'electron', rotation='vertical')
-
-        if self['sscale']:
-#            pylab.figure(figsize=(2,2))
-            
-            pylab.pcolor(numpy.zeros([1, 1]), cmap=pylab.get_cmap(name=self['cmap']), vmin=0., vmax=self.maxOm)
-            
-            pylab.colorbar()
-            
-        pylab.axis('off')            
-        pylab.savefig('axes.%s'%self['output_format'], dpi=self['plot_dpi'])
+        nproc = min(self.opt_dict.get('nproc', 1), len(jobs))
+        if nproc > 1:
+            # every process renders a contiguous block of states into its own figure
+            nblock = (len(jobs) + nproc - 1) // nproc
+            blocks = [jobs[i:i+nblock] for i in range(0, len(jobs), nblock)]
+            pool = multiprocessing.Pool(nproc)
+            pool.map(plot_states, [(block, popts) for block in blocks])
+            pool.close()
+            pool.join()
+        elif len(jobs) > 0:
+            plot_states((jobs, popts))
+        
+        plot_axes(popts, self.maxOm)
             
         tel  = '<img src="axes.%s", border="1" width="200">\n'%self['output_format']
         tel += '<br>Axes / Scale'
@@ -162,18 +162,124 @@ class OmFrag_options(input_options.write_options):
         hfile.write(htable.ret_table())    
         hfile.post()
         
+        json.dump(new_cache, open(self.cache_file, 'w'), indent=1)
+        
         print(" HTML file %s containing the electron-hole correlation plots written."%hfname)
 
+class read_plot_options(input_options.read_options):
+    def set_defaults(self):
+        self['plot_type'] = 1
+        self['plot_dpi'] = 200
+        self['cmap'] = 'Greys'
+        self['fsize'] = 10
+        self['output_format'] = 'png'
+        self['sscale'] = True
+        self['vmax'] = None # default: maximal value of all states
+        self['axis'] = True
+        self['ticks'] = False
+        self['cbar'] = False
+        self['nproc'] = 1
+        self['use_cache'] = True
+
+def plot_states(args):
+    """
+    Plot the OmFrag matrices for a list of (pname, OmFrag) pairs.
+    Only one figure is created and cleared after every state.
+    This function is also used by the worker processes.
+    """
+    jobs, popts = args
+    
+    matplotlib.rc('font', size=popts['fsize'])
+    fig = pylab.figure(figsize=(2,2))
+    
+    try:
+        for pname, OmFrag in jobs:
+            if popts['plot_type'] == 1:
+                plot_arr = OmFrag
+            elif popts['plot_type'] == 2:
+                plot_arr = numpy.sqrt(OmFrag)
+            else:
+                raise error_handler.ElseError(str(popts['plot_type']), 'plot_type')
+            
+            if popts['sscale']:
+                vmax = popts['vmax']
+            else:
+                vmax = OmFrag.max()
+            
+            fig.clf()
+            ax = fig.add_subplot(111)
+            numF = len(plot_arr)
+            im = ax.imshow(plot_arr, cmap=pylab.get_cmap(popts['cmap']), vmin=0., vmax=vmax,
+                           origin='lower', extent=(0, numF, 0, numF), aspect='auto', interpolation='nearest')
+            
+            if popts['axis']:
+                ax.axis('on')
+                if popts['ticks']:
+                    ax.set_xticks([x + 0.5 for x in range(numF)])
+                    ax.set_xticklabels([x + 1 for x in range(numF)])
+                    ax.set_yticks([y + 0.5 for y in range(numF)])
+                    ax.set_yticklabels([y + 1 for y in range(numF)])
+                else:
+                    ax.set_xticks([])
+                    ax.set_yticks([])
+            else:
+                ax.axis('off')
+            
+            if popts['cbar']: fig.colorbar(im, ax=ax)
+            
+            print("Writing %s ..."%pname)
+            fig.savefig(pname, dpi=popts['plot_dpi'])
+    finally:
+        pylab.close(fig)
+        
+def plot_axes(popts, maxOm):
+    """
+    Create a plot with the e/h axes and optionally the scale.
+    """
+    matplotlib.rc('font', size=popts['fsize'])
+    fig = pylab.figure(figsize=(2,2))
+    ax = fig.add_subplot(111)
+    ax.arrow(0.15, 0.15, 0.5, 0., head_width=0.05, head_length=0.1, fc='k', ec='k')
+    ax.text(0.20, 0.05, 'hole')
+    ax.arrow(0.15, 0.15, 0., 0.5, head_width=0.05, head_length=0.1, fc='k', ec='k')    
+    ax.text(0.02, 0.20, 'electron', rotation='vertical')
+    ax.set_xlim(0., 1.)
+    ax.set_ylim(0., 1.)
+    
+    if popts['sscale']:
+        sm = matplotlib.cm.ScalarMappable(cmap=pylab.get_cmap(popts['cmap']), norm=matplotlib.colors.Normalize(0., maxOm))
+        sm.set_array([])
+        fig.colorbar(sm, ax=ax)
+        
+    ax.axis('off')
+    fig.savefig('axes.%s'%popts['output_format'], dpi=popts['plot_dpi'])
+    pylab.close(fig)
+
 def run_plot():
-    Oopt = OmFrag_options('plot.in')        
+    infilen = 'plot.in'
+    
+    Oopt = OmFrag_options(infilen)
+    ropt = read_plot_options(infilen, False)
     Oopt.read_OmFrag()
     
-    Oopt.OmFrag_input()
+    if ropt.init == 0:
+        copy = Oopt.ret_yn('Found %s. Use this file directly rather than performing an interactive input?'%infilen, True)
+    else:
+        copy = False
+    
+    if copy:
+        Oopt.copy(ropt)
+        if Oopt.get('vmax', strict=False) is None: Oopt['vmax'] = Oopt.maxOm
+    else:
+        Oopt.OmFrag_input()
     
     Oopt.plot()
     
+    if not copy:
+        Oopt.flush()
+    
     
 if __name__ == '__main__':
     theo_header.print_header('Plot Omega matrices')
 
-    run_plot()
\ No newline at end of file
+    run_plot()
@@ -4,7 +4,7 @@ Script for creating graphs from multiple directories, e.g. potential curves.
 """
 
 import theo_header, input_options, error_handler, lib_file
-import os
+import os, json, multiprocessing
 
 class write_plot_options(input_options.write_options):
     """
@@ -41,39 +41,92 @@ class write_plot_options(input_options.write_options):
             self.read_str("Format of output graphics files", "output_format", "png")
             
         self.read_yn('Print txt files with the information', 'dotxt', True)
+        self.read_int('Number of processes for reading and plotting', 'nproc', 1)
+        if self.read_yn('Cache the data of the summary files for later runs', 'use_cache', True):
+            self.write_option('cache_file', 'graph_cache.json')
         
     def read_data(self):
         """
         Read the data from the individual directories into individual dictionaries.
         Arranged as:
         [ana_dir] - {state_label} - {key}
+        The summary files are read in a process pool, files that did not change since
+            the last run are taken from the cache file.
         """
-        self.data = []
         self.main_header = ''
+        
+        use_cache = self.opt_dict.get('use_cache', False)
+        cache = self.read_cache() if use_cache else {}
+        
+        fnames = [os.path.join(ana_dir, self['ana_file']) for ana_dir in self['ana_dirs']]
+        stamps = [ret_stamp(fname) for fname in fnames]
+        
+        entries = [None for fname in fnames]
+        todo = []
+        for i, fname in enumerate(fnames):
+            if fname in cache and cache[fname]['stamp'] == stamps[i]:
+                entries[i] = cache[fname]
+            else:
+                todo.append(i)
+        
+        print("Reading %i summary files (%i taken from the cache)"%(len(fnames), len(fnames) - len(todo)))
+        for i, entry in zip(todo, self.run_jobs(read_summ, [fnames[i] for i in todo])):
+            entry['stamp'] = stamps[i]
+            entries[i] = entry
+        
+        self.data = []
+        for entry in entries:
+            if self.main_header == '': self.main_header = entry['header']
+            self.data.append(entry['ddict'])
+        
+        if use_cache:
+            cache.update(zip(fnames, entries))
+            json.dump(cache, open(self['cache_file'], 'w'))
+        
+    def read_cache(self):
+        try:
+            return json.load(open(self['cache_file']))
+        except (IOError, ValueError):
+            return {}
+        
+    def ret_keys(self):
+        return [key for key in self.main_header[1:] if key != 'fname']
+        
+    def ret_series(self, key):
+        """
+        Return a list of (state, values) pairs for the property key.
+        The values are None if the property is not available in all directories.
+        """
+        series = []
+        for state in self['state_labels']:
+            try:
+                ylist = [ddict[state][key] for ddict in self.data]
+            except KeyError:
+                ylist = None
+            series.append((state, ylist))
             
-        for ana_dir in self['ana_dirs']:
-            sfile = lib_file.summ_file(os.path.join(ana_dir, self['ana_file']))
-            header = sfile.ret_header()
-            ddict  = sfile.ret_ddict()
-            
-            if self.main_header == '': self.main_header = header
-            self.data.append(ddict)            
-            
-        #print self.data
+        return series
+        
+    def run_jobs(self, function, jobs):
+        """
+        Run the jobs (files or properties), possibly in a process pool.
+        Return the results in the order of jobs.
+        """
+        nproc = min(self.opt_dict.get('nproc', 1), len(jobs))
+        if nproc > 1:
+            pool = multiprocessing.Pool(nproc)
+            ret = pool.map(function, jobs)
+            pool.close()
+            pool.join()
+            return ret
+        else:
+            return [function(job) for job in jobs]
         
     def plot(self):
         """
         Create the plots.
         For this purpose, self.data has to be rearranged.
         """
-        try:
-            import matplotlib
-            matplotlib.use('Agg')
-            import pylab
-        except:
-            print("pylab/matplotlib not installed - plotting not possible")
-            raise
-        
         hfname = 'graphs.html'
         hfile = lib_file.htmlfile(hfname)
         hfile.pre('Property graphs')
@@ -82,41 +135,15 @@ class write_plot_options(input_options.write_options):
         
         #set1 = self.data[0][self['state_labels'][0]] # not used anywhere??
         
-        matplotlib.rc('font', size=self['fsize'])
-        
-        for key in self.main_header[1:]:
-            if key == 'fname': continue
-            
-            print('Plotting %s ...'%key)
-            pylab.figure(figsize=(6,4))
-            
-            for state in self['state_labels']:
-                ylist = []
-                for iana_dir in range(len(self['ana_dirs'])):
-                    try:
-                        ylist.append(self.data[iana_dir][state][key])
-                    except KeyError:
-                        print(" ... not able to plot %s for %s."%(key, state))
-                        break
-                else:
-                    pylab.plot(list(range(len(ylist))), ylist, 'x-', label=state)
-            
-            pylab.title(key)
-            
-            numx = len(self['ana_dirs'])
-            pylab.xticks(range(numx), self['ana_dirs'], rotation=30)
-            #pylab.margins(0.20)
-            pylab.subplots_adjust(bottom=0.15)
-            pylab.xlim((-0.5, numx+1.5))
-            
-            pylab.ylabel(key)
-            pylab.legend()
-            
+        jobs = []
+        for key in self.ret_keys():
             pname = '%s.%s'%(key, self['output_format'])
-            pylab.savefig(pname)
+            jobs.append((key, pname, self.ret_series(key), self['ana_dirs'], self['fsize']))
             
             tel  = '<img src="%s", border="1" width="400">'%pname
             htable.add_el(tel)
+            
+        self.run_jobs(plot_key, jobs)
                 
         hfile.write(htable.ret_table()) 
         hfile.post()
@@ -127,28 +154,8 @@ class write_plot_options(input_options.write_options):
         """
         Create compact text files that contain all the required info.
         """
-        for key in self.main_header[1:]:
-            if key == 'fname': continue
-            
-            fname = '%s.txt'%key
-            print('Writing %s ...'%fname)
-            
-            wf = open(fname, 'w')
-            
-            wf.write('%10s'%'dir')
-            for state in self['state_labels']:
-                wf.write('%10s'%state)
-
-            wf.write('\n')                
-            for idir, ana_dir in enumerate(self['ana_dirs']):
-                wf.write('%10s'%ana_dir)
-                
-                for state in self['state_labels']:
-                    wf.write('%10.5f'%self.data[idir][state][key])
-                
-                wf.write('\n')
-                
-            wf.close()
+        jobs = [(key, '%s.txt'%key, self.ret_series(key), self['ana_dirs']) for key in self.ret_keys()]
+        self.run_jobs(write_txt, jobs)
 
 class read_plot_options(input_options.read_options):
     def set_defaults(self):
@@ -159,7 +166,84 @@ class read_plot_options(input_options.read_options):
         self['output_format']='png'
         self['doplots']=True
         self['dotxt']=True
+        self['nproc']=1 # processes for reading and plotting
+        self['use_cache']=True # reuse the data of unchanged summary files
+        self['cache_file']='graph_cache.json'
         
+def ret_stamp(fname):
+    """
+    Modification time and size of the summary file (text or .npz, as read by summ_file).
+    """
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return [None, None]
+        
+    return [st.st_mtime, st.st_size]
+        
+def read_summ(fname):
+    """
+    Read one summary file. This function is also used by the worker processes.
+    """
+    sfile = lib_file.summ_file(fname)
+    return {'header': sfile.ret_header(), 'ddict': sfile.ret_ddict()}
+
+def plot_key(args):
+    """
+    Plot one property for all states. This function is also used by the worker processes.
+    """
+    key, pname, series, ana_dirs, fsize = args
+    
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import pylab
+    except:
+        print("pylab/matplotlib not installed - plotting not possible")
+        raise
+    
+    matplotlib.rc('font', size=fsize)
+    
+    print('Plotting %s ...'%key)
+    fig = pylab.figure(figsize=(6,4))
+    
+    for state, ylist in series:
+        if ylist is None:
+            print(" ... not able to plot %s for %s."%(key, state))
+        else:
+            pylab.plot(list(range(len(ylist))), ylist, 'x-', label=state)
+    
+    pylab.title(key)
+    
+    numx = len(ana_dirs)
+    pylab.xticks(range(numx), ana_dirs, rotation=30)
+    #pylab.margins(0.20)
+    pylab.subplots_adjust(bottom=0.15)
+    pylab.xlim((-0.5, numx+1.5))
+    
+    pylab.ylabel(key)
+    pylab.legend()
+    
+    pylab.savefig(pname)
+    pylab.close(fig)
+
+def write_txt(args):
+    """
+    Write the text file for one property. This function is also used by the worker processes.
+    """
+    key, fname, series, ana_dirs = args
+    print('Writing %s ...'%fname)
+    
+    for state, ylist in series:
+        if ylist is None:
+            raise error_handler.MsgError("%s not available for %s in all directories"%(key, state))
+    
+    lines = ['%10s'%'dir' + ''.join('%10s'%state for state, ylist in series)]
+    for idir, ana_dir in enumerate(ana_dirs):
+        lines.append('%10s'%ana_dir + ''.join('%10.5f'%ylist[idir] for state, ylist in series))
+    
+    open(fname, 'w').write('\n'.join(lines) + '\n')
+
 def run_plot():
     infilen = 'graph.in'
     
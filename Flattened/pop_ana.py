@@ -14,15 +14,9 @@ class pop_ana:
         raise error_handler.PureVirtualError()
     
     def ret_pop(self, dens, mos, Deff=None):
-        if Deff==None: Deff = self.ret_Deff(dens, mos)
+        if Deff is None: Deff = self.ret_Deff(dens, mos)
         
-        mp = numpy.zeros(mos.num_at)
-        
-        for ibas in range(mos.ret_num_bas()):
-            iat = mos.basis_fcts[ibas].at_ind - 1
-            mp[iat] += Deff[ibas, ibas]
-            
-        return mp    
+        return mos.basis_fcts.ret_at_pop(Deff.diagonal(), mos.num_at)
 
 class mullpop_ana(pop_ana):
     """
@@ -54,7 +48,7 @@ class pop_printer:
         """
         Add population data to be stored in the printer class.
         """
-        if pop==None: return
+        if pop is None: return
         
         self.pop_types.append(pop_type)
         self.pops.append(pop)
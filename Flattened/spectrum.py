@@ -3,8 +3,8 @@
 Create a convoluted spectrum from the oscillator strengths.
 """
 
-import math
-import theo_header, units, lib_file, input_options
+import theo_header, units, lib_file, input_options, error_handler
+import numpy
 
 do_plots = True
 try:
@@ -17,127 +17,285 @@ except:
 
 class spec_options(input_options.write_options):
     def spec_input(self):
+        self.choose_list("Unit of the energy grid", "xunit",
+                         [('eV', 'Electronvolt'),
+                          ('nm', 'Wavelength in nm'),
+                          ('rcm', 'Wavenumbers in cm-1')], 'eV')
         self.read_int("Number of points in the spectrum", "npts", 200)
-        self.read_float("Minimum energy in the plot (eV)", "emin", 2.0)
-        self.read_float("Maximum energy in the plot (eV)", "emax", 8.0)
-        self.read_float("FWHM broadening (eV)", "fwhm", 0.5)
+        self.read_float("Minimum energy in the plot (%s)"%self['xunit'], "emin", 2.0)
+        self.read_float("Maximum energy in the plot (%s)"%self['xunit'], "emax", 8.0)
+        self.read_float("FWHM broadening (%s)"%self['xunit'], "fwhm", 0.5)
         self.read_int("Lineshape: 1 - Lorentzian, 2 - Gaussian", "lineshape", 1)
-        
+        self.choose_list("Broadening method", "mode",
+                         [('direct', 'Direct summation'),
+                          ('fft', 'Histogram and FFT convolution (for many sticks)')], 'direct')
+        if self['mode'] == 'fft':
+            self.read_int("Refinement factor of the grid", "refine", 4)
+            self.read_float("Accuracy (truncation of the lineshape)", "acc", 1.e-6)
+
         self.spec = spectrum(**self.opt_dict)
-        
-        self.read_str("Name of the file to analyze", "ana_file", "tden_summ.txt")
-        
+
+        rstr = self.ret_str("Name(s) of the file(s) to analyze (separated by spaces)\n  Several files are averaged", "tden_summ.txt")
+        self.write_list('ana_files', rstr.split(), lformat="'%s'")
+
     def make_spec(self):
-        sfile = lib_file.summ_file(self['ana_file'])
-        header = sfile.ret_header()
-        ddict  = sfile.ret_ddict()
-        state_labels = sfile.ret_state_labels()
-        
-        for state in state_labels:
+        """
+        Read the sticks from all summary files and average the spectra.
+        """
+        nfile = len(self['ana_files'])
+        for ana_file in self['ana_files']:
+            sfile = lib_file.summ_file(ana_file)
+
             try:
-                f = ddict[state]['f']
+                f = numpy.nan_to_num(sfile.ret_col('f'))
             except KeyError:
-                f = 0.           
-            
-            self.spec.add(f, ddict[state]['dE(eV)'])
+                f = numpy.zeros(len(sfile.ret_state_labels()))
+
+            self.spec.add_sticks(f / nfile, sfile.ret_col('dE(eV)'))
+
+        if self.spec.mode == 'fft': self.spec.check_accuracy()
 
         self.spec.normalize()
-        
+
         self.spec.ascii_file()
 
         if do_plots:
             self.spec.plot(xunit='eV', pname='spectrum_eV.png')
             self.spec.plot(xunit='nm', pname='spectrum_nm.png')
-        
+
+def conv_en(en, xunit):
+    """
+    Convert energies given in eV to xunit (eV, nm, rcm).
+    """
+    en = numpy.asarray(en, dtype=float)
+
+    if xunit == 'eV':
+        return en
+    elif xunit == 'nm':
+        with numpy.errstate(divide='ignore'):
+            return units.energy['nm'] * units.energy['eV'] / en
+    elif xunit in ['rcm', 'cm-1']:
+        return en / units.energy['eV'] * units.energy['rcm']
+    else:
+        raise error_handler.ElseError(xunit, 'xunit')
+
+def conv_en_inv(val, xunit):
+    """
+    Convert values given in xunit to eV.
+    """
+    val = numpy.asarray(val, dtype=float)
+
+    if xunit == 'nm':
+        with numpy.errstate(divide='ignore'):
+            return units.energy['nm'] * units.energy['eV'] / val
+    elif xunit in ['rcm', 'cm-1']:
+        return val / units.energy['rcm'] * units.energy['eV']
+    else:
+        return conv_en(val, xunit)
+
 # Code adapted from SHARC
 class gauss:
     def __init__(self,fwhm):
-        self.c=-4.*math.log(2.)/fwhm**2
-        
+        self.c=-4.*numpy.log(2.)/fwhm**2
+
     def ev(self,A,x0,x):
-        return A*math.exp( self.c*(x-x0)**2)
+        return A*numpy.exp( self.c*(x-x0)**2)
 
 class lorentz:
     def __init__(self,fwhm):
         self.c=0.25*fwhm**2
-        
+
     def ev(self,A,x0,x):
         return A/( (x-x0)**2/self.c+1)
 
+def direct_conv(grid, A, x0, lshape, chunk_size=2**22):
+    """
+    Sum of the lineshape functions for all sticks on the grid.
+    The sticks are processed in chunks such that at most chunk_size elements
+        are allocated at once.
+    """
+    spec = numpy.zeros(len(grid))
+    nchunk = max(1, chunk_size // max(1, len(grid)))
+    for istart in range(0, len(A), nchunk):
+        Ac  = A[istart:istart+nchunk, None]
+        x0c = x0[istart:istart+nchunk, None]
+        spec += lshape.ev(Ac, x0c, grid[None, :]).sum(axis=0)
+
+    return spec
+
+def ret_margin(lshape, acc):
+    """
+    Distance from the center at which the lineshape drops below acc (relative to the maximum).
+    """
+    if isinstance(lshape, gauss):
+        return numpy.sqrt(numpy.log(acc) / lshape.c)
+    else:
+        return numpy.sqrt(lshape.c * (1. / acc - 1.))
+
+def fft_conv(grid, A, x0, lshape, refine=4, acc=1.e-6):
+    """
+    Fast broadening for large numbers of sticks.
+    The sticks are distributed onto a grid that is refine times finer than grid
+        (linear interpolation between the two neighbouring points), and this
+        histogram is convoluted with the lineshape by FFT.
+    The lineshape is truncated where it drops below acc, sticks further away from
+        the grid are neglected.
+    grid has to be equidistant.
+    """
+    npts = len(grid)
+    if npts < 2: return direct_conv(grid, A, x0, lshape)
+
+    h = (grid[-1] - grid[0]) / (npts - 1) / refine
+    nmarg = int(numpy.ceil(ret_margin(lshape, acc) / abs(h)))
+
+    # fine grid, which contains the grid points at every refine-th point
+    nfine = (npts - 1) * refine + 1 + 2 * nmarg
+    start = grid[0] - nmarg * h
+
+    # histogram of the sticks
+    pos = (x0 - start) / h
+    mask = (pos >= 0.) & (pos < nfine - 1)
+    pos, A = pos[mask], A[mask]
+    ind = numpy.floor(pos).astype(int)
+    w = pos - ind
+    hist = numpy.bincount(ind, A * (1. - w), minlength=nfine) + numpy.bincount(ind + 1, A * w, minlength=nfine)
+
+    # convolution with the kernel sampled at the distances -nmarg*h ... nmarg*h
+    kernel = lshape.ev(1., 0., numpy.arange(-nmarg, nmarg + 1) * h)
+    nfft = 1
+    while nfft < nfine + len(kernel) - 1: nfft *= 2
+    conv = numpy.fft.irfft(numpy.fft.rfft(hist, nfft) * numpy.fft.rfft(kernel, nfft), nfft)
+
+    return conv[2*nmarg : 2*nmarg + (npts - 1) * refine + 1 : refine]
+
+def broaden(A, x0, npts=200, emin=2., emax=8., fwhm=0.5, lineshape=1, xunit='eV', mode='direct', refine=4, acc=1.e-6):
+    """
+    Library function: return the grid (in xunit) and the broadened spectrum
+        for the intensities A at the energies x0 (eV).
+    """
+    spec = spectrum(npts, emin, emax, fwhm, lineshape, xunit=xunit, mode=mode, refine=refine, acc=acc)
+    spec.add_sticks(A, x0)
+    return spec.grid, spec.spec
+
 class spectrum:
-    def __init__(self,npts,emin,emax,fwhm,lineshape):
+    """
+    Broadened spectrum on an equidistant grid in the unit xunit (eV, nm, rcm).
+    The positions of the sticks are given in eV.
+    mode='direct': explicit summation of the lineshapes
+    mode='fft': histogram on a refined grid and FFT convolution (see fft_conv)
+    """
+    def __init__(self,npts,emin,emax,fwhm,lineshape,xunit='eV',mode='direct',refine=4,acc=1.e-6,**kwargs):
       self.npts=npts
+      self.xunit=xunit
+      self.mode=mode
+      self.refine=refine
+      self.acc=acc
       if lineshape==1:
           self.f=gauss(fwhm)
       elif lineshape==2:
           self.f=lorentz(fwhm)
-      
-      self.en = [emin + float(i)/self.npts*(emax-emin) for i in range(self.npts+1)]       # the energy grid needs to be calculated only once
-      lamev = units.energy['nm'] * units.energy['eV']
-      self.lam = [lamev / en for en in self.en]
-      self.spec=[ 0. for i in range(self.npts+1) ]
-      
-      self.sticks=[] # list of pairs (A,x0)
-      
+
+      self.grid = numpy.linspace(emin, emax, self.npts+1)
+      self.en = conv_en_inv(self.grid, xunit) # energies in eV
+      self.lam = conv_en(self.en, 'nm')
+      self.spec = numpy.zeros(self.npts+1)
+
+      self.sticks = numpy.zeros([0, 2]) # pairs (A,x0), x0 in eV
+
     def add(self,A,x0):
-        if A==0.:
+        self.add_sticks([A], [x0])
+
+    def add_sticks(self, A, x0):
+        """
+        Add a set of sticks with intensities A at the energies x0 (eV).
+        """
+        A = numpy.asarray(A, dtype=float)
+        x0 = numpy.asarray(x0, dtype=float)
+
+        mask = A != 0.
+        A, x0 = A[mask], x0[mask]
+        if len(A) == 0:
             return
-        
-        self.sticks += [(A,x0)]
-        
-        for i in range(self.npts+1):
-            self.spec[i]+=self.f.ev(A,x0,self.en[i])
-    
+
+        self.sticks = numpy.concatenate((self.sticks, numpy.array([A, x0]).transpose()))
+        if self.mode == 'direct':
+            self.spec += direct_conv(self.grid, A, conv_en(x0, self.xunit), self.f)
+        elif self.mode == 'fft':
+            self.spec += fft_conv(self.grid, A, conv_en(x0, self.xunit), self.f, self.refine, self.acc)
+        else:
+            raise error_handler.ElseError(self.mode, 'mode')
+
+    def check_accuracy(self, nsample=1000, lvprt=1):
+        """
+        Compare the fast broadening against the direct summation for a sample of the sticks.
+        Return the maximal deviation relative to the maximum of the spectrum.
+        """
+        if len(self.sticks) == 0: return 0.
+
+        inds = numpy.arange(len(self.sticks))
+        if len(inds) > nsample:
+            inds = numpy.random.RandomState(1).choice(inds, nsample, replace=False)
+        A = self.sticks[inds, 0]
+        x0 = conv_en(self.sticks[inds, 1], self.xunit)
+
+        sdir = direct_conv(self.grid, A, x0, self.f)
+        sfft = fft_conv(self.grid, A, x0, self.f, self.refine, self.acc)
+        err = abs(sfft - sdir).max() / abs(sdir).max()
+
+        if lvprt >= 1:
+            print('Deviation of the FFT broadening from the direct summation (%i sticks): %.2e'%(len(inds), err))
+        return err
+
     def normalize(self):
-        smax = max(self.spec)
+        smax = self.spec.max()
         print('Normalizing the spectrum ...')
         print('Maximum: % .5f'%smax)
-        for i, sp in enumerate(self.spec):
-            self.spec[i] = sp / smax
-
-        for i, stick in enumerate(self.sticks):
-            self.sticks[i] = (stick[0] / smax, stick[1])
+        self.spec /= smax
+        self.sticks[:, 0] /= smax
 
     def ascii_file(self, fname='spectrum.dat'):
         wf = lib_file.wfile(fname)
-        
+
         wt = lib_file.asciitable(ncol=3)
         for i, en in enumerate(self.en):
             wt.add_row([en, self.spec[i], self.lam[i]])
-        
+
         wf.write(wt.ret_table())
         wf.post(lvprt=1)
-        
-    def plot(self, xunit=1, pname='spectrum.png', lvprt=1):
+
+    def plot(self, xunit='eV', pname='spectrum.png', lvprt=1):
         pylab.figure(figsize=(8,6))
-                
+
         if xunit.lower() == 'ev':
             xlist = self.en
             pylab.xlabel('Energy (eV)')
-            xfac = 0.
         elif xunit.lower() == 'nm':
             xlist = self.lam
             #pylab.xlabel(r'$\lambda$') not working ...
             pylab.xlabel('Wavelength (nm)')
-            xfac = units.energy['nm'] * units.energy['eV']
+        elif xunit.lower() in ['rcm', 'cm-1']:
+            xlist = conv_en(self.en, 'rcm')
+            pylab.xlabel('Wavenumber (cm-1)')
         else:
             raise error_handler.ElseError(xunit, 'xunit')
         pylab.ylabel('Absorption (norm.)')
-        
+
         pylab.plot(xlist, self.spec, 'k-')
-        
-        for A,x0 in self.sticks:
-            pylab.plot([xfac/x0, xfac/x0], [0., A], 'r-')
-        
+
+        xsticks = conv_en(self.sticks[:, 1], 'rcm' if xunit.lower() == 'cm-1' else xunit.replace('ev', 'eV'))
+        # all sticks in one collection
+        pylab.vlines(xsticks, 0., self.sticks[:, 0], colors='r')
+
         pylab.savefig(pname)
-        
+        pylab.close()
+
         if lvprt >= 1:
             print("Spectrum file %s created."%pname)
-    
+
 if __name__ == '__main__':
     theo_header.print_header('Create a convoluted spectrum')
-    
+
     sopt = spec_options('spectrum.in')
     sopt.spec_input()
-    
-    sopt.make_spec()
\ No newline at end of file
+
+    sopt.make_spec()
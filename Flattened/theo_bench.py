@@ -0,0 +1,227 @@
+#!/usr/bin/python
+"""
+Benchmarks for the density analysis kernels using synthetic workloads of scalable size.
+The results are written to a JSON file and can be compared against a stored baseline.
+"""
+
+import theo_header, lib_mo, lib_tden, lib_sden, input_options, error_handler
+import numpy
+import os, sys, io, time, json, shutil, tempfile, contextlib
+
+# shells on every atom, the d functions are spherical
+shell_list = ['s', 's', 'p', 'p', 'd']
+num_bas = {'s':1, 'p':3, 'd':5}
+
+def ihelp():
+    print(" theo_bench.py [options]")
+    print(" Command line options:")
+    print("  -h, -H, -help: print this help")
+    print("  -nat [4,16,64]: comma separated list of numbers of atoms (13 basis functions per atom)")
+    print("  -nstate [5]: number of states")
+    print("  -sparsity [0.0]: fraction of zero MO coefficients and density matrix elements")
+    print("  -nrep [3]: number of repetitions (the fastest run is recorded)")
+    print("  -o [bench.json]: output file")
+    print("  -compare <file>: compare against a baseline JSON file")
+    print("  -tol [1.3]: allowed ratio between new and baseline timings")
+    print("  -min_time [0.01]: timings below this value (s) are not checked")
+    exit(0)
+
+#--------------------------------------------------------------------------#
+# Synthetic input
+#--------------------------------------------------------------------------#
+
+def write_molden(fname, nat, nmo, sparsity, rng):
+    """
+    Write a Molden file with random geometry and MO coefficients.
+    Zero coefficients are omitted in the [MO] section.
+    """
+    nbas = nat * sum(num_bas[shell] for shell in shell_list)
+
+    mld = open(fname, 'w')
+    mld.write('[Molden Format]\n[Atoms] Angs\n')
+    for iat in range(nat):
+        mld.write('C %5i 6 % .6f % .6f % .6f\n'%((iat+1,) + tuple(3. * rng.rand(3) * nat**(1./3.))))
+    mld.write('[5D]\n[GTO]\n')
+    for iat in range(nat):
+        mld.write('%i 0\n'%(iat+1))
+        for shell in shell_list:
+            mld.write(' %s 1 1.00\n  1.0 1.0\n'%shell)
+        mld.write('\n')
+
+    C = rng.rand(nbas, nmo) - 0.5
+    C += 2. * numpy.eye(nbas, nmo) # well conditioned
+    C[rng.rand(nbas, nmo) < sparsity] = 0.
+
+    mld.write('[MO]\n')
+    for imo in range(nmo):
+        mld.write(' Sym= %ia\n Ene= %.5f\n Spin= Alpha\n Occup= %.1f\n'%(imo+1, 0.1*imo, 2. if 2*imo < nmo else 0.))
+        for ibas in numpy.flatnonzero(C[:, imo]):
+            mld.write('%6i % .10f\n'%(ibas+1, C[ibas, imo]))
+    mld.close()
+
+    return nbas
+
+def ret_dens(nmo, nstate, sparsity, rng, sym=False):
+    """
+    Return a list of random (transition) density matrices in the MO basis.
+    """
+    dens_list = []
+    for istate in range(nstate):
+        D = rng.rand(nmo, nmo) - 0.5
+        D[rng.rand(nmo, nmo) < sparsity] = 0.
+        if sym: D = D + D.transpose()
+        dens_list.append(D / numpy.sqrt((D*D).sum()))
+
+    return dens_list
+
+#--------------------------------------------------------------------------#
+# Timing
+#--------------------------------------------------------------------------#
+
+def time_kernel(function, nrep, setup=None):
+    """
+    Return the wall times of nrep runs of function.
+    The output of the kernels is suppressed.
+    """
+    times = []
+    for irep in range(nrep):
+        if setup is not None: setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            tt = time.time()
+            function()
+            times.append(time.time() - tt)
+
+    return times
+
+def run_bench(nat, nstate, sparsity, nrep, seed=1):
+    """
+    Run all kernels for one system size in a temporary directory.
+    """
+    rng = numpy.random.RandomState(seed)
+    results = {}
+    pdir = os.getcwd()
+    tdir = tempfile.mkdtemp(prefix='theo_bench')
+    os.chdir(tdir)
+
+    try:
+        nbas = nat * sum(num_bas[shell] for shell in shell_list)
+        write_molden('bench.mld', nat, nbas, sparsity, rng)
+        key = 'nat=%i,nbas=%i,nstate=%i,sparsity=%.2f'%(nat, nbas, nstate, sparsity)
+
+        ioptions = input_options.tden_ana_options('dens_ana.in', check_init=False)
+        ioptions['mo_file'] = 'bench.mld'
+        sioptions = input_options.sden_ana_options('dens_ana.in', check_init=False)
+        sioptions['mo_file'] = 'bench.mld'
+
+        mos = lib_mo.MO_set_molden('bench.mld')
+        def molden_read():
+            mos.__init__('bench.mld')
+            mos.read(lvprt=0)
+        results['MO_set_molden.read'] = time_kernel(molden_read, nrep)
+        results['compute_inverse'] = time_kernel(lambda: mos.compute_inverse(lvprt=0), nrep)
+
+        tdena = lib_tden.tden_ana(ioptions)
+        tdena.mos = mos
+        tdens = ret_dens(nbas, nstate, sparsity, rng)
+        def tden_setup():
+            tdena.state_list = [{'name': '%i'%(istate+1), 'tden': tden} for istate, tden in enumerate(tdens)]
+        results['ret_Om_OmAt'] = time_kernel(tdena.compute_all_OmAt, nrep, tden_setup)
+        results['ret_NTO'] = time_kernel(lambda: [tdena.ret_NTO(state) for state in tdena.state_list], nrep, tden_setup)
+
+        sdena = lib_sden.sden_ana(sioptions)
+        sdena.mos = mos
+        sdens = ret_dens(nbas, nstate, sparsity, rng, sym=True)
+        def sden_setup():
+            sdena.state_list = [{'name': '%i'%(istate+1), 'sden': sden} for istate, sden in enumerate(sdens)]
+        results['ret_BO'] = time_kernel(sdena.compute_all_BO, nrep, sden_setup)
+
+        Ct = mos.ret_mo_mat(trnsp=True)
+        results['export_AO'] = time_kernel(lambda: mos.export_AO(mos.ens, mos.occs, Ct, 'export.mld'), nrep)
+    finally:
+        os.chdir(pdir)
+        shutil.rmtree(tdir)
+
+    return key, results
+
+def compare(results, base, tol, min_time):
+    """
+    Compare the best timings against the baseline.
+    Return the number of regressions.
+    """
+    nreg = 0
+    print("\n%-40s %-20s %10s %10s %7s"%('system', 'kernel', 'base (s)', 'new (s)', 'ratio'))
+    for key in sorted(results):
+        if not key in base: continue
+        for kernel, entry in sorted(results[key].items()):
+            if not kernel in base[key]: continue
+            tbase = base[key][kernel]['best']
+            tnew = entry['best']
+            ratio = tnew / tbase if tbase > 0 else 1.
+            flag = ''
+            if tnew > min_time and ratio > tol:
+                flag = ' <-- REGRESSION'
+                nreg += 1
+            print("%-40s %-20s %10.4f %10.4f %7.2f%s"%(key, kernel, tbase, tnew, ratio, flag))
+
+    return nreg
+
+#--------------------------------------------------------------------------#
+# Main
+#--------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+    theo_header.print_header('Benchmarks of the density analysis kernels')
+
+    nat_list = [4, 16, 64]
+    nstate = 5
+    sparsity = 0.
+    nrep = 3
+    ofile = 'bench.json'
+    cfile = None
+    tol = 1.3
+    min_time = 0.01
+
+    arg = sys.argv.pop(0)
+    while len(sys.argv) > 0:
+        arg = sys.argv.pop(0)
+        if arg in ["-h", "-H", "-help"]:
+            ihelp()
+        elif arg == '-nat':
+            nat_list = [int(nat) for nat in sys.argv.pop(0).split(',')]
+        elif arg == '-nstate':
+            nstate = int(sys.argv.pop(0))
+        elif arg == '-sparsity':
+            sparsity = float(sys.argv.pop(0))
+        elif arg == '-nrep':
+            nrep = int(sys.argv.pop(0))
+        elif arg == '-o':
+            ofile = sys.argv.pop(0)
+        elif arg == '-compare':
+            cfile = sys.argv.pop(0)
+        elif arg == '-tol':
+            tol = float(sys.argv.pop(0))
+        elif arg == '-min_time':
+            min_time = float(sys.argv.pop(0))
+        else:
+            raise error_handler.ElseError(arg, 'command line option')
+
+    results = {}
+    for nat in nat_list:
+        key, times = run_bench(nat, nstate, sparsity, nrep)
+        results[key] = {}
+        print(key)
+        for kernel, ktimes in times.items():
+            results[key][kernel] = {'best': min(ktimes), 'times': ktimes}
+            print("  %-20s %10.4f s"%(kernel, min(ktimes)))
+
+    json.dump(results, open(ofile, 'w'), indent=1)
+    print("\nResults written to %s"%ofile)
+
+    if cfile is not None:
+        base = json.load(open(cfile))
+        nreg = compare(results, base, tol, min_time)
+        if nreg > 0:
+            print("\n%i regression(s) found!"%nreg)
+            sys.exit(1)
+        else:
+            print("\nNo regressions found.")